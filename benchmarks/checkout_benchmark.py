@@ -0,0 +1,216 @@
+"""
+Drive /checkout/{sessionid} in process against the fake Stripe server and report, per cart size,
+the Stripe round trips and the p50/p99 latency of a checkout.
+
+    python -m benchmarks.checkout_benchmark --sizes 1,5,10,20 --iterations 30 --latency-ms 40
+
+Scenarios:
+    cold    Stripe and the local mirror start empty, every line creates its product
+    warm    The catalog is provisioned, every checkout is a new cart and creates its payment link
+    repeat  The same cart checks out again, the payment link is reused
+
+Nothing leaves the machine, the app runs on a SQLite database and key table cache in a temporary
+directory unless --database-url points elsewhere. --json writes the results for comparing runs.
+"""
+import os
+import io
+import sys
+import json
+import math
+import time
+import uuid
+import base64
+import argparse
+import datetime
+import tempfile
+import statistics
+
+from benchmarks.fake_stripe import FakeStripeServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("cold", "warm", "repeat")
+MIDDLEWARE_STRING = "benchmark-session-secret"
+PAYMENT_LINK_HOST = "https://buy.stripe.test/"
+
+
+def percentile(values: list, p: float) -> float:
+    """
+        Nearest rank percentile, p between 0 and 100
+    """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+def configure_environment(workdir: str, stripe_url: str, database_url: str) -> None:
+    """
+        Point the app at the fake Stripe server and local storage before it is imported,
+        the key table is written to the cache so NocoDB is never called
+    """
+    keys = {
+        "middleware_string": MIDDLEWARE_STRING,
+        "openapi_url": "None",
+        "enviornment": "development",
+        "test_shipping_rate": "shr_benchmark",
+        "dev_website": "http://testserver",
+    }
+    cache_dir = os.path.join(workdir, "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "key_table.json"), "w") as f:
+        json.dump({"envvars": list(keys), "envvals": list(keys.values())}, f)
+    os.environ.update(keys)
+    os.environ.update({
+        "cache_dir": cache_dir,
+        "database_url": database_url,
+        "nocodb_path": "http://127.0.0.1:9",
+        "nocodb_xc_token": "benchmark",
+        "stripe_secret_key": "sk_test_benchmark",
+        "stripe_api_base": stripe_url,
+        "stripe_max_network_retries": "0",
+        "development_hosts": "testserver",
+        "development_origins": "http://testserver",
+    })
+
+def jpeg_data_uri(index: int) -> str:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 300), ((index * 37) % 256, (index * 91) % 256, 128)).save(buffer, "JPEG", quality=85)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+def seed_catalog(db, models, count: int) -> list:
+    """
+        Add artwork to an empty catalog
+
+        Returns:
+            list: The titles and prices of the catalog, in catalog order
+    """
+    if db.query(models.Artwork).count() < count:
+        now = datetime.datetime.now()
+        start = db.query(models.Artwork).count()
+        for i in range(start + 1, count + 1):
+            db.add(models.Artwork(
+                id=i, sortorder=i, img_label=f"Benchmark Print {i}", img=str([{"path": f"benchmark/{i}.jpg"}]),
+                price=str(50 + 10 * i), uri=jpeg_data_uri(i), height="16", width="20", created_at=now, updated_at=now,
+            ))
+        db.commit()
+    return [(row.img_label, int(row.price)) for row in db.query(models.Artwork).order_by(models.Artwork.sortorder).all()]
+
+def create_cart(db, models, catalog: list, lines: int) -> str:
+    """
+        Store a cart of the first lines artworks under a new session id
+
+        Returns:
+            str: The session id
+    """
+    session_id = str(uuid.uuid4())
+    img_quant_list = [
+        {"title": title, "quantity": 1 + i % 3, "price": str(price * (1 + i % 3))}
+        for i, (title, price) in enumerate(catalog[:lines])
+    ]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    db.add(models.Cookies(sessionids=session_id, cookies={"img_quantity_list": img_quant_list}, created_at=now, updated_at=now))
+    db.commit()
+    return session_id
+
+def session_cookie(session_id: str) -> str:
+    # Signed the way Starlette's SessionMiddleware signs it
+    from itsdangerous import TimestampSigner
+
+    data = base64.b64encode(json.dumps({"session_id": session_id}).encode("utf-8"))
+    return TimestampSigner(MIDDLEWARE_STRING).sign(data).decode("utf-8")
+
+def run(args) -> list:
+    workdir = tempfile.mkdtemp(prefix="checkout-benchmark-")
+    server = FakeStripeServer(latency=args.latency_ms / 1000).start()
+    fake = server.stripe
+    configure_environment(workdir, server.url, args.database_url or f"sqlite:///{os.path.join(workdir, 'brig.db')}")
+
+    sys.path.insert(0, REPO_ROOT)
+    from fastapi.testclient import TestClient
+    from src import app as app_module
+    from src.artapi import crud, models
+    from src.artapi.postgres import SessionLocal, engine
+
+    models.Base.metadata.create_all(bind=engine)
+    app_module.limiter.enabled = False
+    client = TestClient(app_module.app, follow_redirects=False)
+    db = SessionLocal()
+    catalog = seed_catalog(db, models, max(args.sizes))
+    app_module.noco_db.get_artwork_data_with_cache(db, crud)
+
+    def checkout(session_id: str) -> tuple:
+        client.cookies.clear()
+        fake.reset_counts()
+        started = time.perf_counter()
+        response = client.get(f"/checkout/{session_id}", headers={"Cookie": f"session={session_cookie(session_id)}"})
+        elapsed = time.perf_counter() - started
+        ok = response.status_code in (302, 303, 307) and response.headers.get("location", "").startswith(PAYMENT_LINK_HOST)
+        return elapsed, fake.round_trips, ok, dict(fake.requests)
+
+    results = []
+    for scenario in args.scenarios:
+        if scenario != "cold":
+            fake.reset()
+            crud.replace_stripe_mirror(db, [], [])
+            app_module.provision_stripe_products()
+        for lines in args.sizes:
+            timings, trips, failures, endpoints = [], [], 0, {}
+            repeat_session = create_cart(db, models, catalog, lines)
+            if scenario == "repeat":
+                checkout(repeat_session)
+            for _ in range(args.iterations):
+                if scenario == "cold":
+                    fake.reset()
+                    crud.replace_stripe_mirror(db, [], [])
+                session_id = repeat_session if scenario == "repeat" else create_cart(db, models, catalog, lines)
+                elapsed, round_trips, ok, endpoints = checkout(session_id)
+                timings.append(elapsed)
+                trips.append(round_trips)
+                failures += not ok
+            results.append({
+                "scenario": scenario,
+                "lines": lines,
+                "iterations": args.iterations,
+                "failures": failures,
+                "round_trips": statistics.median(trips),
+                "max_round_trips": max(trips),
+                "p50_ms": percentile(timings, 50) * 1000,
+                "p99_ms": percentile(timings, 99) * 1000,
+                "mean_ms": statistics.mean(timings) * 1000,
+                "endpoints": endpoints,
+            })
+    db.close()
+    server.shutdown()
+    return results
+
+def report(results: list, latency_ms: float) -> None:
+    print(f"Stripe latency {latency_ms:.0f} ms per round trip")
+    print(f"{'scenario':<8} {'lines':>5} {'trips':>6} {'max':>5} {'p50 ms':>9} {'p99 ms':>9} {'mean ms':>9} {'failed':>6}")
+    for result in results:
+        print(
+            f"{result['scenario']:<8} {result['lines']:>5} {result['round_trips']:>6g} {result['max_round_trips']:>5} "
+            f"{result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['mean_ms']:>9.1f} {result['failures']:>6}"
+        )
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark /checkout/{sessionid} against a local fake Stripe")
+    parser.add_argument("--sizes", default="1,5,10,15,20", help="Comma separated cart sizes in lines")
+    parser.add_argument("--iterations", type=int, default=20, help="Checkouts per scenario and cart size")
+    parser.add_argument("--latency-ms", type=float, default=40.0, help="Delay the fake adds to every Stripe call")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated subset of cold, warm and repeat")
+    parser.add_argument("--database-url", help="Database to run against, a temporary SQLite file by default")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+    args.sizes = [int(size) for size in args.sizes.split(",")]
+    args.scenarios = [scenario for scenario in args.scenarios.split(",") if scenario in SCENARIOS]
+
+    results = run(args)
+    report(results, args.latency_ms)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"latency_ms": args.latency_ms, "results": results}, f, indent=2)
+    if any(result["failures"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""
+A local stand in for the parts of the Stripe API the shop uses: Products, Prices, Files,
+FileLinks and PaymentLinks. State lives in memory, every request is counted per endpoint and
+can be delayed to model the network round trip to Stripe.
+
+Run on its own and point the app at it with stripe_api_base:
+
+    python -m benchmarks.fake_stripe --port 12111 --latency-ms 40
+    stripe_api_base=http://127.0.0.1:12111 uvicorn src.app:app
+"""
+import re
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit
+
+RESOURCES = {
+    "products": ("prod", "product"),
+    "prices": ("price", "price"),
+    "files": ("file", "file"),
+    "file_links": ("link", "file_link"),
+    "payment_links": ("plink", "payment_link"),
+}
+_KEY_PARTS = re.compile(r"\[([^\]]*)\]")
+
+
+def _set(target: dict, keys: list, value: str) -> None:
+    for i, key in enumerate(keys):
+        last = i == len(keys) - 1
+        if key == "":
+            # a[]=x appends to a list
+            key = str(len(target))
+        if last:
+            target[key] = value
+        else:
+            target = target.setdefault(key, {})
+
+def _listify(value):
+    if isinstance(value, dict):
+        value = {key: _listify(item) for key, item in value.items()}
+        if value and all(key.isdigit() for key in value):
+            return [value[key] for key in sorted(value, key=int)]
+    return value
+
+def decode_form(body: str) -> dict:
+    """
+        Decode a Stripe style form body, a[b][0][c]=x becomes {"a": {"b": [{"c": "x"}]}}
+
+        Arguments:
+            body (str): The application/x-www-form-urlencoded body or query string
+
+        Returns:
+            dict: The nested parameters, values are left as strings
+    """
+    params = {}
+    for name, value in parse_qsl(body, keep_blank_values=True):
+        head = name.split("[", 1)[0]
+        _set(params, [head] + _KEY_PARTS.findall(name[len(head):]), value)
+    return _listify(params)
+
+def _bool(value, default: bool = True) -> bool:
+    if value is None:
+        return default
+    return value in (True, "true", "True", "1")
+
+def _int(value) -> Union[int, None]:
+    return int(value) if value not in (None, "") else None
+
+
+class FakeStripe:
+    """
+    The in memory objects and request counts of one fake Stripe account
+    """
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+            Drop every object and count, as if the account were new
+        """
+        with self.lock:
+            self.objects: Dict[str, Dict[str, dict]] = {resource: {} for resource in RESOURCES}
+            # Idempotency key to the hash of the request it was first used with, and the response
+            self.idempotent: Dict[str, Tuple[str, Tuple[int, dict]]] = {}
+            self.requests: Counter = Counter()
+
+    def reset_counts(self) -> None:
+        with self.lock:
+            self.requests = Counter()
+
+    @property
+    def round_trips(self) -> int:
+        with self.lock:
+            return sum(self.requests.values())
+
+    def _new(self, resource: str, **fields) -> dict:
+        prefix, object_name = RESOURCES[resource]
+        obj = {"id": f"{prefix}_{uuid.uuid4().hex[:24]}", "object": object_name, "created": int(time.time()), "livemode": False}
+        obj.update(fields)
+        self.objects[resource][obj["id"]] = obj
+        return obj
+
+    def _create_price(self, product_id: str, params: dict) -> dict:
+        return self._new(
+            "prices",
+            product=product_id,
+            unit_amount=_int(params.get("unit_amount")),
+            currency=params.get("currency", "usd"),
+            tax_behavior=params.get("tax_behavior", "unspecified"),
+            active=_bool(params.get("active")),
+            type="one_time",
+        )
+
+    def create(self, resource: str, params: dict, upload_size: int = 0) -> Tuple[int, dict]:
+        if resource == "products":
+            product = self._new(
+                "products",
+                name=params.get("name"),
+                active=_bool(params.get("active")),
+                metadata=params.get("metadata") or {},
+                images=params.get("images") or [],
+                shippable=_bool(params.get("shippable"), False),
+                tax_code=params.get("tax_code"),
+                default_price=None,
+                updated=int(time.time()),
+            )
+            if "default_price_data" in params:
+                product["default_price"] = self._create_price(product["id"], params["default_price_data"])["id"]
+            return 200, product
+        if resource == "prices":
+            if params.get("product") not in self.objects["products"]:
+                return _error(400, f"No such product: '{params.get('product')}'")
+            return 200, self._create_price(params["product"], params)
+        if resource == "files":
+            return 200, self._new("files", purpose="product_image", size=upload_size, type="jpg")
+        if resource == "file_links":
+            if params.get("file") not in self.objects["files"]:
+                return _error(400, f"No such file: '{params.get('file')}'")
+            link = self._new("file_links", file=params["file"], expired=False)
+            link["url"] = f"https://files.stripe.test/links/{link['id']}"
+            return 200, link
+        if resource == "payment_links":
+            link = self._new("payment_links", active=True, line_items=params.get("line_items") or [])
+            link["url"] = f"https://buy.stripe.test/{link['id']}"
+            return 200, link
+        return _error(404, f"Unrecognized request URL: /v1/{resource}")
+
+    def update(self, resource: str, object_id: str, params: dict) -> Tuple[int, dict]:
+        obj = self.objects.get(resource, {}).get(object_id)
+        if obj is None:
+            return _error(404, f"No such {resource[:-1]}: '{object_id}'")
+        for key, value in params.items():
+            if key == "active":
+                value = _bool(value)
+            elif key == "unit_amount":
+                value = _int(value)
+            elif key == "metadata":
+                value = {**obj.get("metadata", {}), **value}
+            obj[key] = value
+        obj["updated"] = int(time.time())
+        return 200, obj
+
+    def retrieve(self, resource: str, object_id: str) -> Tuple[int, dict]:
+        obj = self.objects.get(resource, {}).get(object_id)
+        if obj is None:
+            return _error(404, f"No such {resource[:-1]}: '{object_id}'")
+        return 200, obj
+
+    def list(self, resource: str, params: dict) -> Tuple[int, dict]:
+        # Newest first, like Stripe
+        objects = sorted(self.objects.get(resource, {}).values(), key=lambda obj: obj["created"], reverse=True)
+        if "active" in params:
+            objects = [obj for obj in objects if obj.get("active") == _bool(params["active"])]
+        if "product" in params:
+            objects = [obj for obj in objects if obj.get("product") == params["product"]]
+        if "starting_after" in params:
+            ids = [obj["id"] for obj in objects]
+            if params["starting_after"] in ids:
+                objects = objects[ids.index(params["starting_after"]) + 1:]
+        limit = min(_int(params.get("limit")) or 10, 100)
+        return 200, {
+            "object": "list",
+            "url": f"/v1/{resource}",
+            "has_more": len(objects) > limit,
+            "data": objects[:limit],
+        }
+
+    def handle(self, method: str, path: str, params: dict, idempotency_key: Union[str, None], upload_size: int = 0) -> Tuple[int, dict]:
+        """
+            Answer one API request
+
+            Arguments:
+                method (str): GET or POST
+                path (str): The request path, /v1/<resource> or /v1/<resource>/<id>
+                params (dict): The decoded query or form parameters
+                idempotency_key (str): The Idempotency-Key header, None if there is none
+                upload_size (int): The body size of a multipart file upload
+
+            Returns:
+                tuple: The HTTP status and the JSON body
+        """
+        parts = [part for part in path.split("/") if part]
+        if len(parts) < 2 or parts[0] != "v1" or parts[1] not in RESOURCES:
+            return _error(404, f"Unrecognized request URL ({method}: {path})")
+        resource = parts[1]
+        object_id = parts[2] if len(parts) > 2 else None
+        endpoint = f"{method} /v1/{resource}" + ("/{id}" if object_id else "")
+        with self.lock:
+            self.requests[endpoint] += 1
+            if method == "POST" and idempotency_key:
+                request_hash = _request_hash(path, params, upload_size)
+                if idempotency_key in self.idempotent:
+                    first_hash, first_result = self.idempotent[idempotency_key]
+                    if first_hash != request_hash:
+                        # Stripe refuses a key reused with other parameters instead of replaying it
+                        return _error(
+                            400,
+                            f"Keys for idempotent requests can only be used with the same parameters they were first used with. "
+                            f"Try using a key other than '{idempotency_key}' if you meant to execute a different request.",
+                            "idempotency_error",
+                        )
+                    return first_result
+            if method == "GET":
+                result = self.retrieve(resource, object_id) if object_id else self.list(resource, params)
+            elif object_id:
+                result = self.update(resource, object_id, params)
+            else:
+                result = self.create(resource, params, upload_size)
+            if method == "POST" and idempotency_key:
+                self.idempotent[idempotency_key] = (request_hash, result)
+            return result
+
+
+def _error(status: int, message: str, error_type: str = "invalid_request_error") -> Tuple[int, dict]:
+    return status, {"error": {"type": error_type, "message": message}}
+
+def _request_hash(path: str, params: dict, upload_size: int) -> str:
+    # File uploads are compared by size, their contents are not kept
+    return hashlib.sha256(json.dumps([path, params, upload_size], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, without this every response waits on a delayed ACK
+    disable_nagle_algorithm = True
+    server: "FakeStripeServer"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _respond(self, method: str) -> None:
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        upload_size = 0
+        if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+            # File contents are not kept, only their size
+            params, upload_size = {}, len(body)
+        else:
+            params = decode_form(url.query if method == "GET" else body.decode("utf-8"))
+        if self.server.stripe.latency:
+            time.sleep(self.server.stripe.latency)
+        status, payload = self.server.stripe.handle(method, url.path, params, self.headers.get("Idempotency-Key"), upload_size)
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Request-Id", f"req_{uuid.uuid4().hex[:14]}")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        self._respond("GET")
+
+    def do_POST(self) -> None:
+        self._respond("POST")
+
+    def do_DELETE(self) -> None:
+        self._respond("DELETE")
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        super().__init__((host, port), FakeStripeHandler)
+        self.stripe = FakeStripe(latency)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeStripeServer":
+        threading.Thread(target=self.serve_forever, name="fake-stripe", daemon=True).start()
+        return self
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a local fake of the Stripe API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Delay added to every request")
+    args = parser.parse_args()
+    server = FakeStripeServer(args.host, args.port, args.latency_ms / 1000)
+    print(f"Fake Stripe listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for endpoint, count in sorted(server.stripe.requests.items()):
+            print(f"{count:6d}  {endpoint}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,61 @@
 # app/main.py
+import time
+IMPORT_STARTED = time.perf_counter()
+
 from fastapi import (
-    FastAPI, Request, HTTPException, Depends, Response
+    FastAPI, Request, HTTPException, Depends, Response, Query
 )
 from contextlib import asynccontextmanager
+from functools import partial
 from fastapi.responses import ( 
-    HTMLResponse, JSONResponse, RedirectResponse, FileResponse
+    HTMLResponse, JSONResponse, RedirectResponse, FileResponse, PlainTextResponse, StreamingResponse
 )
 from fastapi.responses import Response
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
 import os
 import uuid
+import hmac
+import signal
+import multiprocessing
 import stripe
 from datetime import datetime, timezone
 import asyncio
+from sqlalchemy import inspect, text
 from sqlalchemy.orm import Session
-from typing import List
-import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
+from typing import List, Union
 import requests
 import base64
 import ast
 import csv
 import tempfile
+from urllib.parse import urlsplit
 
 from src.artapi import models, crud, schemas, utils
 from src.artapi.noco import Noco
-from src.artapi.noco_config import OPENAPI_URL, SHIPPING_RATE, PROD_WEBSITE
+from src.artapi.noco_config import (
+    OPENAPI_URL, SHIPPING_RATE, PROD_WEBSITE, KEY_DATA_SOURCE, KEY_DATA_LOAD_SECONDS, refresh_key_data
+)
 from src.artapi.stripe_connector import get_stripe_api, StripeAPI
-from src.artapi.config import STRIPE_SECRET_KEY, NOCODB_PATH
-from src.artapi.logger import setup_logger
+from src.artapi.config import (
+    STRIPE_SECRET_KEY, NOCODB_PATH, STRIPE_WEBHOOK_SECRET, STRIPE_RECONCILE_SECONDS, STRIPE_PROVISION_SECONDS,
+    LOG_API_TOKEN, METRICS_TOKEN, LOG_BACKUP_COUNT, ARTWORK_REVALIDATE_SECONDS,
+    KEY_REFRESH_SECONDS
+)
+from src.artapi.snapshot import acquire_refresher_lock
+from src.artapi.logger import log_dir, setup_logger
+from src.artapi.log_reader import iter_logs, log_files
 from src.artapi.middleware import add_middleware, limiter
+from src.artapi.feed import iter_google_feed
+from src.artapi.metrics import registry
+from src.artapi.render_cache import PAGE_CACHE_CONTROL, RenderCache, etag_matches, make_etag, not_modified
+from src.artapi.static_assets import StaticManifest, VersionedStaticFiles, combined_hash, hash_files, static_url_global
 from src.artapi.postgres import engine, SessionLocal
 from src.artapi.models import (
     Title, TitleQuantity, TotalPrice
 )
 
-# Create tables
-models.Base.metadata.create_all(bind=engine)
-
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -53,20 +68,217 @@ desc = "Backend platform for BRIG ART"
 
 logger = setup_logger()
 
+# Templates compiled during warm up so the first visitor doesn't pay for parsing them
+WARM_UP_TEMPLATES = [
+    "index.html", "shop.html", "shop_art.html", "shop_art_menu.html", "gicle_prints.html",
+    "return_policy.html", "privacy_policy.html", "terms_and_conditions.html",
+    "confirmation.html", "error_500.html",
+]
+WARM_UP_RETRY_SECONDS = 5
+
 async def delete_expired_sessions_task():
     while True:
         try:
-            Noco().delete_expired_sessions()
+            await asyncio.to_thread(noco_db.delete_expired_sessions)
         except Exception as e:
             logger.error(f"Error in lifespan: {e}")
         await asyncio.sleep(60)
-        
+
+def reconcile_stripe_mirror() -> None:
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        get_stripe_api().reconcile_mirror(db)
+        logger.info(f"Stripe mirror reconciled in {time.perf_counter() - started:.2f}s")
+    finally:
+        db.close()
+
+async def reconcile_stripe_mirror_task():
+    # Only the refresher worker reconciles, the others read the mirror it keeps
+    if not acquire_refresher_lock():
+        return
+    while True:
+        try:
+            await asyncio.to_thread(reconcile_stripe_mirror)
+        except Exception as e:
+            logger.error(f"Error reconciling Stripe mirror: {e}")
+        await asyncio.sleep(STRIPE_RECONCILE_SECONDS)
+
+async def revalidate_artwork_task():
+    # The refresher checks the catalog on a timer so edits reach every worker, and the Stripe
+    # provisioning that reads its cache, even when the refresher itself gets no requests
+    if not acquire_refresher_lock():
+        return
+    while True:
+        await asyncio.sleep(ARTWORK_REVALIDATE_SECONDS)
+        if noco_db.previous_data.artwork is None:
+            continue
+        try:
+            await asyncio.to_thread(noco_db.flights.do, "artwork", noco_db.revalidate_artwork_data)
+        except Exception as e:
+            logger.error(f"Error revalidating artwork data: {e}")
+
+def provision_stripe_products() -> Union[str, None]:
+    """
+        Provision Stripe products for the current catalog
+
+        Returns:
+            str: The artwork version that was provisioned, None if some artwork failed
+    """
+    db = SessionLocal()
+    try:
+        artwork_data = noco_db.get_artwork_data_with_cache(db, crud)
+        stripe_api = get_stripe_api()
+        stripe_api.ensure_mirror(db)
+        started = time.perf_counter()
+        if not stripe_api.provision_catalog(db, artwork_data):
+            return None
+        logger.info(f"Stripe products provisioned for {len(artwork_data)} artworks in {time.perf_counter() - started:.2f}s")
+        return artwork_data.version
+    finally:
+        db.close()
+
+async def provision_stripe_products_task():
+    # Products are created when the catalog changes, so checkout never waits on image uploads
+    if not acquire_refresher_lock():
+        return
+    provisioned = None
+    while True:
+        artwork_data = noco_db.previous_data.artwork
+        if artwork_data is not None and artwork_data.version != provisioned:
+            try:
+                provisioned = await asyncio.to_thread(provision_stripe_products)
+            except Exception as e:
+                logger.error(f"Error provisioning Stripe products: {e}")
+        await asyncio.sleep(STRIPE_PROVISION_SECONDS)
+
+def bootstrap_schema() -> None:
+    # Create tables
+    models.Base.metadata.create_all(bind=engine)
+    # create_all leaves existing tables alone, columns added to them since are added here
+    table = models.StripeProduct.__tablename__
+    columns = {column["name"] for column in inspect(engine).get_columns(table)}
+    if "image_path" not in columns:
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN image_path VARCHAR"))
+        logger.info(f"Added column image_path to {table}")
+
+def refresh_config() -> None:
+    started = time.perf_counter()
+    changed = refresh_key_data()
+    logger.debug(f"Key table refreshed from NocoDB in {time.perf_counter() - started:.2f}s")
+    if changed:
+        restart_workers()
+
+def restart_workers() -> None:
+    # Secrets were read at import, only new workers use a rotated key. They boot from the cache just written.
+    if multiprocessing.parent_process() is None:
+        logger.error("Key table changed since the app started, restart it to use the new values")
+        return
+    # Started with --workers, uvicorn's supervisor replaces every worker on SIGHUP
+    logger.warning("Key table changed since the workers started, asking the supervisor to restart them")
+    os.kill(os.getppid(), signal.SIGHUP)
+
+def warm_up_caches() -> None:
+    """
+        Populate the artwork and icon caches and compile the page templates
+    """
+    db = SessionLocal()
+    try:
+        noco_db.get_artwork_data_with_cache(db, crud)
+        noco_db.get_icon_data(db, crud)
+    finally:
+        db.close()
+    for name in WARM_UP_TEMPLATES:
+        templates.get_template(name)
+    warm_up_pages()
+
+def warm_up_request(path: str) -> Request:
+    # Pages are cached per scheme and host, warm them up for the production website
+    url = urlsplit(PROD_WEBSITE)
+    port = url.port or (443 if url.scheme == "https" else 80)
+    return Request({
+        "type": "http", "app": app, "router": app.router, "method": "GET",
+        "scheme": url.scheme, "server": (url.hostname, port), "client": ("127.0.0.1", 0),
+        "path": path, "root_path": "", "query_string": b"",
+        "headers": [(b"host", url.netloc.encode("utf-8"))],
+    })
+
+def warm_up_pages() -> None:
+    """
+        Render the catalog pages into the page cache
+    """
+    db = SessionLocal()
+    try:
+        # Rendered directly, the route handlers would spend the rate limit of real traffic from 127.0.0.1
+        pages = [(path, name, partial(context, db)) for path, name, context in CATALOG_PAGES]
+        for record in noco_db.get_artwork_data_with_cache(db, crud):
+            title = record.title.replace(" ", "+")
+            pages.append((f"/shop/{title}", "shop.html", partial(shop_context, db, title)))
+        for path, name, context in pages:
+            try:
+                render_page(warm_up_request(path), db, name, context)
+            except Exception as e:
+                logger.error(f"Error warming up {path}: {e}")
+    finally:
+        db.close()
+
+async def refresh_config_task():
+    # Workers boot from the cached key table, the refresher checks it against NocoDB on a timer
+    if not acquire_refresher_lock():
+        return
+    while True:
+        try:
+            await asyncio.to_thread(refresh_config)
+        except Exception as e:
+            logger.error(f"Error refreshing key table: {e}")
+        await asyncio.sleep(KEY_REFRESH_SECONDS)
+
+async def bootstrap_schema_task():
+    # Retried on its own so a database outage doesn't hold back serving from the catalog snapshot
+    while True:
+        try:
+            await asyncio.to_thread(bootstrap_schema)
+            return
+        except Exception as e:
+            logger.error(f"Error creating tables: {e}")
+        await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+
+async def warm_up_task(app: FastAPI):
+    # Keep retrying, /ready stays 503 until the caches are populated
+    while True:
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(warm_up_caches)
+            app.state.ready = True
+            logger.info(f"Cache warm up completed in {time.perf_counter() - started:.2f}s")
+            return
+        except Exception as e:
+            logger.error(f"Error in cache warm up: {e}")
+        await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
       # Create an instance of Noco
+    app.state.ready = False
+    # Serve the last persisted catalog until the warm up confirms it against the database
+    noco_db.load_snapshot()
+    schema = asyncio.create_task(bootstrap_schema_task())
+    warm_up = asyncio.create_task(warm_up_task(app))
+    config = asyncio.create_task(refresh_config_task())
     task = asyncio.create_task(delete_expired_sessions_task())
+    reconcile = asyncio.create_task(reconcile_stripe_mirror_task())
+    provision = asyncio.create_task(provision_stripe_products_task())
+    revalidate = asyncio.create_task(revalidate_artwork_task())
+    logger.info(f"Startup completed in {(time.perf_counter() - IMPORT_STARTED) * 1000:.0f}ms")
     yield
+    schema.cancel()
+    warm_up.cancel()
+    config.cancel()
     task.cancel()
+    reconcile.cancel()
+    provision.cancel()
+    revalidate.cancel()
     try:
         task
     except asyncio.CancelledError:
@@ -99,8 +311,12 @@ templates_dir = os.path.join(script_dir, "templates")
 
 
 # Static files and templates
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
+static_manifest = StaticManifest(static_dir)
+app.mount("/static", VersionedStaticFiles(directory=static_dir, manifest=static_manifest), name="static")
 templates = Jinja2Templates(directory=templates_dir)
+templates.env.globals["static_url"] = static_url_global(static_manifest)
+# Changes with every deploy that changes a template or a static asset
+SITE_VERSION = f"{combined_hash(hash_files(templates_dir))}.{static_manifest.version}"
 
 
 # Figure out why email get's locked out
@@ -121,29 +337,147 @@ def global_exception_handler(request: Request, exc: Exception):
     return templates.TemplateResponse("error_500.html", {"request": request}, status_code=500)
 
 noco_db = Noco()
+page_cache = RenderCache()
+GOOGLE_FEED_KEY = ("google_feed",)
+
+def render_page(request: Request, db: Session, name: str, context) -> Response:
+    """
+        Render a catalog page through the page cache, pages only change with the catalog version
+
+        Arguments:
+            name (str): The template to render
+            context (callable): Builds the template context, only called on a cache miss
+
+        Returns:
+            Response: The cached page, compressed when the client accepts it, or 304 when the client's copy is current
+    """
+    # Load the catalog, and start a revalidation when one is due, before reading its version
+    noco_db.get_artwork_data_with_cache(db, crud)
+    version = noco_db.get_catalog_version()
+    # url_for renders absolute URLs, so the page also depends on the scheme and host
+    key = (str(request.base_url), request.url.path)
+    etag = make_etag(SITE_VERSION, version, name, *key)
+    page = page_cache.get(key, version)
+    if page is None:
+        body = templates.get_template(name).render({"request": request, **context()})
+        page = page_cache.put(key, version, body.encode("utf-8"))
+    # Only a page that rendered is not modified, a page whose context fails still errors
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return not_modified(etag)
+    return page.response(request, etag)
+
+def homepage_context(db: Session) -> dict:
+    # Records are already sorted by sortorder
+    artwork_data = noco_db.get_artwork_data_with_cache(db, crud)
+    return {
+        "art_uris": [record.data_uri for record in artwork_data],
+        "art_titles": [record.title for record in artwork_data],
+        "brig_logo": noco_db.get_icon_uri_from_title(db, crud, "brig_logo")
+    }
+
+def shop_context(db: Session, title: str) -> dict:
+    height = float(noco_db.get_artwork_height_from_title(db, crud, title.replace("+", " ")))
+    width = float(noco_db.get_artwork_width_from_title(db, crud, title.replace("+", " ")))
+    
+    # Convert height and width to formatted string
+    height_str = utils.format_inches(height)
+    width_str = utils.format_inches(width)
+    
+    return {
+        "img_uri": noco_db.get_art_uri_from_title(db, crud, title.replace("+", " ")),
+        "img_title": title.replace("+", " "),
+        "price": noco_db.get_art_price_from_title(db, crud, title.replace("+", " ")),
+        "brig_logo" : noco_db.get_icon_uri_from_title(db, crud, "brig_logo"),
+        "height": height_str,  # Send as formatted string
+        "width": width_str,    # Send as formatted string
+        "heightmargin": utils.format_inches(height + 0.5),  # Adjust margin with formatted string
+        "widthmargin": utils.format_inches(width + 0.5),    # Adjust margin with formatted string
+        "fireplacesize": noco_db.get_icon_uri_from_title(db, crud, "collage6")
+    }
+
+def shop_art_menu_context(db: Session) -> dict:
+    # Records are already sorted by sortorder
+    artwork_data = noco_db.get_artwork_data_with_cache(db, crud)
+    return {
+        "art_uris": [record.data_uri for record in artwork_data],
+        "titles": [record.title for record in artwork_data],
+        "price_list": [record.price for record in artwork_data],
+        "brig_logo": noco_db.get_icon_uri_from_title(db, crud, "brig_logo")
+    }
+
+def giclee_prints_context(db: Session) -> dict:
+    return {
+        "giclee_prints": [record.data_uri for record in noco_db.get_artwork_data_with_cache(db, crud)],
+        "brig_logo_url": noco_db.get_icon_uri_from_title(db, crud,"brig_logo")
+    }
+
+def logo_context(db: Session) -> dict:
+    return {
+        "brig_logo": noco_db.get_icon_uri_from_title(db, crud, "brig_logo")
+    }
+
+# The pages rendered from the catalog alone, warmed up into the page cache
+CATALOG_PAGES = (
+    ("/", "index.html", homepage_context),
+    ("/shop_art_menu", "shop_art_menu.html", shop_art_menu_context),
+    ("/giclee_prints", "gicle_prints.html", giclee_prints_context),
+    ("/return_policy", "return_policy.html", logo_context),
+    ("/privacy_policy", "privacy_policy.html", logo_context),
+    ("/terms_and_conditions", "terms_and_conditions.html", logo_context),
+)
 
+logger.info(
+    f"App imported in {(time.perf_counter() - IMPORT_STARTED) * 1000:.0f}ms, "
+    f"key table loaded from {KEY_DATA_SOURCE} in {KEY_DATA_LOAD_SECONDS * 1000:.0f}ms"
+)
+
+@app.get("/ready")
+def ready(request: Request):
+    if not getattr(app.state, "ready", False):
+        return JSONResponse({"status": "warming up"}, status_code=503)
+    return JSONResponse({"status": "ready"})
+
+def require_bearer_token(request: Request, token: Union[str, None]) -> None:
+    # Endpoints without a configured token don't exist
+    if not token:
+        raise HTTPException(status_code=404, detail="Not found")
+    scheme, _, supplied = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(supplied.encode("utf-8"), token.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Unauthorized", headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/metrics", response_class=PlainTextResponse)
+@limiter.limit("60/minute")
+def metrics(request: Request):
+    # Prometheus text format, the metrics of this worker only
+    require_bearer_token(request, METRICS_TOKEN)
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/logs")
+@limiter.limit("30/minute")
+def read_logs(
+    request: Request,
+    file: Union[str, None] = None,
+    offset: Union[int, None] = Query(None, ge=0),
+    inode: Union[int, None] = Query(None, ge=0),
+    since: Union[datetime, None] = None,
+    until: Union[datetime, None] = None,
+    level: Union[str, None] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    tail: int = Query(200, ge=0, le=10000),
+):
+    # Streams log entries as JSON lines, the last line is the cursor to pass back as file, offset and inode
+    require_bearer_token(request, LOG_API_TOKEN)
+    try:
+        entries = iter_logs(log_files(log_dir, backup_count=LOG_BACKUP_COUNT), file, offset, inode, since, until, level, limit, tail)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(entries, media_type="application/x-ndjson", headers={"Cache-Control": "no-store"})
 
 @app.get("/", response_class=HTMLResponse)
 def homepage(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Homepage accessed by: {request.client.host}")
+    logger.debug(f"Homepage accessed by: {request.client.host}")
     try:
-        artwork_data = noco_db.get_artwork_data_with_cache(db, crud)
-        
-        # Sort artwork by sortorder
-        sorted_artwork = sorted(
-            zip(artwork_data.sortorder, artwork_data.data_uris, artwork_data.titles),
-            key=lambda x: x[0]
-        )
-        
-        art_uris, art_titles = zip(*[(art[1], art[2]) for art in sorted_artwork])
-
-        context = {
-            "art_uris": art_uris,
-            "art_titles": art_titles,
-            "brig_logo": noco_db.get_icon_uri_from_title(db, crud, "brig_logo"),
-            "version": noco_db.get_version()
-        }
-        return templates.TemplateResponse(request=request, name="index.html", context=context)
+        return render_page(request, db, "index.html", partial(homepage_context, db))
     except Exception as e:
         logger.error(f"Error in homepage: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -151,28 +485,9 @@ def homepage(request: Request, db: Session = Depends(get_db)):
 @app.get("/shop/{title}", response_class=HTMLResponse)
 @limiter.limit("100/minute")
 def shop(request: Request, title: str, db: Session = Depends(get_db)):
-    logger.info(f"Shop page accessed for title {title} by {request.client.host}")
+    logger.debug(f"Shop page accessed for title {title} by {request.client.host}")
     try:
-        height = float(noco_db.get_artwork_height_from_title(db, crud, title.replace("+", " ")))
-        width = float(noco_db.get_artwork_width_from_title(db, crud, title.replace("+", " ")))
-        
-        # Convert height and width to formatted string
-        height_str = utils.format_inches(height)
-        width_str = utils.format_inches(width)
-        
-        context = {
-            "img_uri": noco_db.get_art_uri_from_title(db, crud, title.replace("+", " ")),
-            "img_title": title.replace("+", " "),
-            "price": noco_db.get_art_price_from_title(db, crud, title.replace("+", " ")),
-            "brig_logo" : noco_db.get_icon_uri_from_title(db, crud, "brig_logo"),
-            "height": height_str,  # Send as formatted string
-            "width": width_str,    # Send as formatted string
-            "version": noco_db.get_version(),
-            "heightmargin": utils.format_inches(height + 0.5),  # Adjust margin with formatted string
-            "widthmargin": utils.format_inches(width + 0.5),    # Adjust margin with formatted string
-            "fireplacesize": noco_db.get_icon_uri_from_title(db, crud, "collage6")
-        }
-        return templates.TemplateResponse(request=request, name="shop.html", context=context)
+        return render_page(request, db, "shop.html", partial(shop_context, db, title))
     except Exception as e:
         logger.error(f"Error in shop: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -180,7 +495,7 @@ def shop(request: Request, title: str, db: Session = Depends(get_db)):
 @app.get("/get_cart_quantity")
 @limiter.limit("100/minute") 
 def get_cart_quantity(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Get cart quantity by {request.client.host}")
+    logger.debug(f"Get cart quantity by {request.client.host}")
     try:
 
         if request.session.get("session_id") is None:
@@ -197,7 +512,7 @@ def get_cart_quantity(request: Request, db: Session = Depends(get_db)):
 @app.post("/shop_art")
 @limiter.limit("100/minute") 
 def shop_art_url(request: Request, title_quantity: TitleQuantity, db: Session = Depends(get_db)):
-    logger.info(f"Shop art URL for {title_quantity.title} by {request.client.host}")
+    logger.debug(f"Shop art URL for {title_quantity.title} by {request.client.host}")
     try:
 
         cookie_data = {}
@@ -268,31 +583,28 @@ def shop_art_url(request: Request, title_quantity: TitleQuantity, db: Session =
 @app.get("/shop_art/{sessionid}", response_class=HTMLResponse)
 @limiter.limit("100/minute") 
 def shop_art(request: Request, sessionid: str, db: Session = Depends(get_db)):
-    logger.info(f"Shop art page accessed by {request.client.host}")
+    logger.debug(f"Shop art page accessed by {request.client.host}")
     try:
    
         if request.session.get("session_id") != sessionid:
             return RedirectResponse(url="/shop_art_menu")       
                          
         img_quant_list = noco_db.get_cookie_from_session_id(db, crud, sessionid)
-        art_uris = noco_db.get_artwork_data_with_cache(db, crud, ).data_uris
-        titles = noco_db.get_artwork_data_with_cache(db, crud).titles
+        artwork_data = noco_db.get_artwork_data_with_cache(db, crud)
         img_data_list = []
         for item in img_quant_list: 
-            for title in titles:
-                if item['title'] in title:
-                    img_url = art_uris[titles.index(title)]
-                    img_dict = {}
-                    img_dict["img_url"] = img_url
-                    img_dict["img_title"] = title
-                    img_dict["quantity"] = item['quantity']
-                    img_dict["price"] = noco_db.get_art_price_from_title_and_quantity(db, crud, item['title'], item['quantity'])
-                    img_data_list.append(img_dict)
+            record = artwork_data.get(item['title'])
+            if record is not None:
+                img_dict = {}
+                img_dict["img_url"] = record.data_uri
+                img_dict["img_title"] = record.title
+                img_dict["quantity"] = item['quantity']
+                img_dict["price"] = noco_db.get_art_price_from_title_and_quantity(db, crud, item['title'], item['quantity'])
+                img_data_list.append(img_dict)
                     
         context = {
             "img_data_list": img_data_list,
-            "brig_logo_url": noco_db.get_icon_uri_from_title(db, crud, "brig_logo"),
-            "version": noco_db.get_version()
+            "brig_logo_url": noco_db.get_icon_uri_from_title(db, crud, "brig_logo")
         }
         return templates.TemplateResponse(request=request, name="shop_art.html", context=context)
     except Exception as e:
@@ -302,26 +614,9 @@ def shop_art(request: Request, sessionid: str, db: Session = Depends(get_db)):
 @app.get("/shop_art_menu", response_class=HTMLResponse)
 @limiter.limit("100/minute") 
 def shop_art_menu(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Shop art menu page accessed by {request.client.host}")
+    logger.debug(f"Shop art menu page accessed by {request.client.host}")
     try:
-        artwork_data = noco_db.get_artwork_data_with_cache(db, crud)
-        
-        # Sort artwork by sortorder
-        sorted_artwork = sorted(
-            zip(artwork_data.sortorder, artwork_data.data_uris, artwork_data.titles, artwork_data.prices),
-            key=lambda x: x[0]
-        )
-        
-        art_uris, art_titles, price_list = zip(*[(art[1], art[2], art[3]) for art in sorted_artwork])
-
-        context = {
-            "art_uris": art_uris,
-            "titles": art_titles,
-            "price_list": price_list,
-            "brig_logo": noco_db.get_icon_uri_from_title(db, crud, "brig_logo"),
-            "version" : noco_db.get_version()
-        }
-        return templates.TemplateResponse(request=request, name="shop_art_menu.html", context=context)
+        return render_page(request, db, "shop_art_menu.html", partial(shop_art_menu_context, db))
     except Exception as e:
         logger.error(f"Error in shop_art_menu: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -329,15 +624,9 @@ def shop_art_menu(request: Request, db: Session = Depends(get_db)):
 @app.get("/giclee_prints", response_class=HTMLResponse)
 @limiter.limit("100/minute") 
 def shop_giclee_prints(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Giclee prints page accessed by {request.client.host}")
+    logger.debug(f"Giclee prints page accessed by {request.client.host}")
     try:
-
-        context = {
-            "giclee_prints": noco_db.get_artwork_data_with_cache(db, crud).data_uris,
-            "brig_logo_url": noco_db.get_icon_uri_from_title(db, crud,"brig_logo"),
-            "version": noco_db.get_version()
-        }
-        return templates.TemplateResponse(request=request, name="gicle_prints.html", context=context)
+        return render_page(request, db, "gicle_prints.html", partial(giclee_prints_context, db))
     except Exception as e:
         logger.error(f"Error in shop_giclee_prints: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -345,7 +634,7 @@ def shop_giclee_prints(request: Request, db: Session = Depends(get_db)):
 @app.post("/post_total_price")
 @limiter.limit("100/minute") 
 def post_total_price(request: Request, total_price: TotalPrice, db: Session = Depends(get_db)):
-    logger.info(f"Post total price {total_price.totalPrice} by {request.client.host}")
+    logger.debug(f"Post total price {total_price.totalPrice} by {request.client.host}")
     try:
         
         img_quant_list = noco_db.get_cookie_from_session_id(db, crud, request.session.get("session_id"))
@@ -362,12 +651,12 @@ def post_total_price(request: Request, total_price: TotalPrice, db: Session = De
 @app.post("/increase_quantity")
 @limiter.limit("100/minute") 
 def increase_quantity(request: Request, title: Title, db: Session = Depends(get_db)):
-    logger.info(f"Increase quantity for {title.title} by {request.client.host}")
+    logger.debug(f"Increase quantity for {title.title} by {request.client.host}")
     try:
 
         session_id = request.session.get("session_id")
         if not session_id:
-            logger.info(f"Session ID not found from request {request.client.host}")
+            logger.debug(f"Session ID not found from request {request.client.host}")
             raise HTTPException(status_code=400, detail="Session ID not found")
 
         img_quant_list = noco_db.get_cookie_from_session_id(db, crud, session_id)
@@ -400,11 +689,11 @@ def increase_quantity(request: Request, title: Title, db: Session = Depends(get_
 @app.post("/decrease_quantity")
 @limiter.limit("100/minute") 
 def decrease_quantity(request: Request, title: Title, db: Session = Depends(get_db)):
-    logger.info(f"Decrease quantity for {title.title} by {request.client.host}")
+    logger.debug(f"Decrease quantity for {title.title} by {request.client.host}")
     try:
         session_id = request.session.get("session_id")
         if not session_id:
-            logger.info(f"Session ID not found from request {request.client.host}")
+            logger.debug(f"Session ID not found from request {request.client.host}")
             raise HTTPException(status_code=400, detail="Session ID not found")
 
         img_quant_list = noco_db.get_cookie_from_session_id(db, crud, session_id)
@@ -447,11 +736,10 @@ def decrease_quantity(request: Request, title: Title, db: Session = Depends(get_
 @app.post("/delete_item")
 @limiter.limit("100/minute") 
 def delete_item(request: Request, title: Title, db: Session = Depends(get_db)):
-    logger.info(f"Delete item by {request.client.host}")
+    logger.debug(f"Delete item by {request.client.host}")
     try:
 
-        titles = noco_db.get_artwork_data_with_cache(db, crud).titles
-        if title.title not in titles:
+        if title.title not in noco_db.get_artwork_data_with_cache(db, crud):
             logger.warning(f"Title {title.title} not found")
             raise HTTPException(status_code=404, detail="Title not found")
 
@@ -490,7 +778,7 @@ def delete_item(request: Request, title: Title, db: Session = Depends(get_db)):
 @app.get("/get_session_id")
 @limiter.limit("100/minute") 
 def get_session_id(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Get session ID by {request.client.host}")
+    logger.debug(f"Get session ID by {request.client.host}")
     try:
         session_id = request.session.get("session_id")
         if session_id is None:
@@ -510,27 +798,19 @@ def favicon(request: Request):
 @app.get("/return_policy", response_class=HTMLResponse)
 @limiter.limit("100/minute") 
 def return_policy(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Return policy page accessed by {request.client.host}")
+    logger.debug(f"Return policy page accessed by {request.client.host}")
     try:
-        context = {
-            "brig_logo": noco_db.get_icon_uri_from_title(db, crud, "brig_logo"),
-            "version": noco_db.get_version()
-        }
-        return templates.TemplateResponse(request=request, name="return_policy.html", context=context)
+        return render_page(request, db, "return_policy.html", partial(logo_context, db))
     except Exception as e:
         logger.error(f"Error in return_policy: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/privacy_policy", response_class=HTMLResponse)
 @limiter.limit("100/minute") 
-def return_policy(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Return policy page accessed by {request.client.host}")
+def privacy_policy(request: Request, db: Session = Depends(get_db)):
+    logger.debug(f"Return policy page accessed by {request.client.host}")
     try:
-        context = {
-            "brig_logo": noco_db.get_icon_uri_from_title(db, crud, "brig_logo"),
-            "version": noco_db.get_version()
-        }
-        return templates.TemplateResponse(request=request, name="privacy_policy.html", context=context)
+        return render_page(request, db, "privacy_policy.html", partial(logo_context, db))
     except Exception as e:
         logger.error(f"Error in return_policy: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -538,13 +818,9 @@ def return_policy(request: Request, db: Session = Depends(get_db)):
 @app.get("/terms_and_conditions", response_class=HTMLResponse)
 @limiter.limit("100/minute")
 def terms_and_conditions(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Terms and conditions page accessed by {request.client.host}")
+    logger.debug(f"Terms and conditions page accessed by {request.client.host}")
     try:
-        context = {
-            "brig_logo": noco_db.get_icon_uri_from_title(db, crud, "brig_logo"),
-            "version": noco_db.get_version()
-        }
-        return templates.TemplateResponse(request=request, name="terms_and_conditions.html", context=context)
+        return render_page(request, db, "terms_and_conditions.html", partial(logo_context, db))
     except Exception as e:
         logger.error(f"Error in terms_and_conditions: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -552,7 +828,7 @@ def terms_and_conditions(request: Request, db: Session = Depends(get_db)):
 @app.get("/get_session_time")
 @limiter.limit("100/minute") 
 def get_session_time(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Get session time by {request.client.host}")
+    logger.debug(f"Get session time by {request.client.host}")
     try:
         session_id = request.session.get("session_id")
         if not session_id:
@@ -577,7 +853,7 @@ def get_session_time(request: Request, db: Session = Depends(get_db)):
 @app.post("/delete_session")
 @limiter.limit("100/minute") 
 def delete_session(request: Request, db: Session = Depends(get_db)):
-    logger.info(f"Delete session by {request.client.host}")
+    logger.debug(f"Delete session by {request.client.host}")
     try:
         session_id = request.session.get("session_id")
         if not session_id:
@@ -592,27 +868,26 @@ def delete_session(request: Request, db: Session = Depends(get_db)):
 @app.get("/confirmation/{sessionid}", response_class=HTMLResponse)
 @limiter.limit("100/minute")
 def confirmation(request: Request, sessionid: str, db: Session = Depends(get_db)):
-    logger.info(f"Confirmation page accessed by {request.client.host}")
+    logger.debug(f"Confirmation page accessed by {request.client.host}")
     try:
         if request.session.get("session_id") != sessionid:
             return RedirectResponse(url="/shop_art_menu")
         
         img_quant_list = noco_db.get_cookie_from_session_id(db, crud, sessionid)
-        img_path = noco_db.get_artwork_data_with_cache(db, crud).art_paths
-        titles = noco_db.get_artwork_data_with_cache(db, crud).titles
+        artwork_data = noco_db.get_artwork_data_with_cache(db, crud)
         path_list = []
 
         for item in img_quant_list:
-            if item["title"] not in titles:
+            record = artwork_data.get(item["title"])
+            if record is None:
                 raise HTTPException(status_code=404, detail=f"Title not found, Abuse detected {request.client.host}")
             else: 
-                full_path = f"{NOCODB_PATH}/{img_path[titles.index(item['title'])]}"
+                full_path = f"{NOCODB_PATH}/{record.art_path}"
                 path_list.append(full_path)
 
         context = {
             "img_quant_list": img_quant_list,
-            "brig_logo_url": noco_db.get_icon_uri_from_title(db, crud, "brig_logo"),
-            "version": noco_db.get_version()
+            "brig_logo_url": noco_db.get_icon_uri_from_title(db, crud, "brig_logo")
         }
         return templates.TemplateResponse(request=request, name="confirmation.html", context=context)
     
@@ -623,56 +898,55 @@ def confirmation(request: Request, sessionid: str, db: Session = Depends(get_db)
 @app.get("/checkout/{sessionid}", response_class=HTMLResponse)
 @limiter.limit("100/minute") 
 def shop_checkout(request: Request, sessionid: str, db: Session = Depends(get_db), stripe_api: StripeAPI = Depends(get_stripe_api)):
-    logger.info(f"Checkout page accessed by {request.client.host}")
+    logger.debug(f"Checkout page accessed by {request.client.host}")
     try:
         if request.session.get("session_id") != sessionid:
             return RedirectResponse(url="/shop_art_menu")
         
         img_quant_list = noco_db.get_cookie_from_session_id(db, crud, sessionid)
-        img_path = noco_db.get_artwork_data_with_cache(db, crud).art_paths
-        titles = noco_db.get_artwork_data_with_cache(db, crud).titles
-        path_list = []
+        artwork_data = noco_db.get_artwork_data_with_cache(db, crud)
+        record_list = []
 
         for item in img_quant_list:
-            if item["title"] not in titles:
+            record = artwork_data.get(item["title"])
+            if record is None:
                 raise HTTPException(status_code=404, detail=f"Title not found, Abuse detected {request.client.host}")
             else: 
-                full_path = f"{NOCODB_PATH}/{img_path[titles.index(item['title'])]}"
-                path_list.append(full_path)
+                record_list.append(record)
 
-        line_items = stripe_api.sync_products(img_quant_list, path_list)
+        line_items = stripe_api.sync_products(img_quant_list, record_list, db)
 
         if line_items == []:
             logger.info("Cart is empty")
             return RedirectResponse(url="/shop_art_menu")
         
-        payment_link = stripe.PaymentLink.create(
-            line_items=line_items,
-            automatic_tax = {
-                'enabled': True,
-                'liability' : {
-                    'type' : 'self',
-                }
-            },
-            shipping_address_collection={
-                'allowed_countries': ['US'],
-            },
-            shipping_options = [{
-                'shipping_rate' : SHIPPING_RATE,
-            }],
-            after_completion={
-                'type': 'redirect',
-                'redirect': {
-                    'url': f"{PROD_WEBSITE}/confirmation/{sessionid}",
-                },
-            },
+        payment_link_url = stripe_api.create_payment_link(
+            line_items, SHIPPING_RATE, f"{PROD_WEBSITE}/confirmation/{sessionid}"
         )
-        return RedirectResponse(url=payment_link.url)
+        return RedirectResponse(url=payment_link_url)
     
     except Exception as e:
         logger.error(f"Error in shop_checkout: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
     
+@app.post("/stripe/webhook")
+async def stripe_webhook(request: Request, db: Session = Depends(get_db), stripe_api: StripeAPI = Depends(get_stripe_api)):
+    if not STRIPE_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Not found")
+    payload = await request.body()
+    try:
+        event = stripe.Webhook.construct_event(payload, request.headers.get("stripe-signature", ""), STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.error.SignatureVerificationError) as e:
+        logger.error(f"Rejected Stripe webhook from {request.client.host}: {e}")
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    try:
+        if await asyncio.to_thread(stripe_api.apply_event, db, event):
+            logger.info(f"Stripe mirror updated from {event.type}")
+        return JSONResponse({"received": True})
+    except Exception as e:
+        logger.error(f"Error in stripe_webhook: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 # Dev APIS
 # Update the artwork order in the database and sync there uris
 # @app.get("/sync-uris", response_class=JSONResponse)
@@ -827,51 +1101,31 @@ def export_google_feed(request: Request, db: Session = Depends(get_db)):
     try:
         # Fetch artwork data from the backend
         artwork_data = noco_db.get_artwork_data_with_cache(db, crud)
-        
-        # Create the root RSS element and associate the Google namespace with the "g" prefix
-        ET.register_namespace('g', "http://base.google.com/ns/1.0")
-        rss = ET.Element('rss', version='2.0')
-        channel = ET.SubElement(rss, 'channel')
-        
-        # Channel info (customize as needed)
-        ET.SubElement(channel, 'title').text = "Brig Light Art"
-        ET.SubElement(channel, 'link').text = PROD_WEBSITE
-        ET.SubElement(channel, 'description').text = "Brig Light Art products"
-        
-        # Iterate through the artwork data and create items
-        for title, price, id, height, width in zip(artwork_data.titles, artwork_data.prices, artwork_data.Ids, artwork_data.heights, artwork_data.widths):
-            item = ET.SubElement(channel, 'item')
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}id').text = str(id)
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}title').text = title
-            
-            # Add brand, MPN, and optionally GTIN
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}brand').text = "Art Ecommerce LLC"
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}mpn').text = f"PRINT-{id}"  # Example MPN
-            
-            # If you have GTINs, you can add them here
-            # ET.SubElement(item, '{http://base.google.com/ns/1.0}gtin').text = "your_gtin_here"
-            
-            # Make the description the size of the artwork
-            cutheight = str(float(height) + 1)
-            cutwidth = str(float(width) + 1)
-            description = f"Large Giclée prints with a half inch white border. Refer to briglightart.com/shop/{str(title).replace(' ', '+')} for more details on specific sizes."
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}description').text = description
-            
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}link').text = f"{PROD_WEBSITE}/shop/{str(title).replace(' ', '+')}"
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}image_link').text = f"{PROD_WEBSITE}/stream_image/{str(id)}"
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}price').text = f"{price} USD"
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}condition').text = "new"
-            ET.SubElement(item, '{http://base.google.com/ns/1.0}availability').text = "in stock"
-        
-        # Convert the XML tree to a string
-        xml_str = ET.tostring(rss, encoding='utf-8')
-        
-        # Parse the string for pretty printing
-        dom = minidom.parseString(xml_str)
-        pretty_xml = dom.toprettyxml(indent="  ")
-        
-        # Return the pretty-printed XML as a response
-        return Response(content=pretty_xml, media_type="application/xml")
+
+        # The feed only changes with the artwork
+        etag = make_etag(SITE_VERSION, artwork_data.version, "google_feed")
+        if etag_matches(request.headers.get("if-none-match", ""), etag):
+            return not_modified(etag)
+
+        version = noco_db.get_catalog_version()
+        page = page_cache.get(GOOGLE_FEED_KEY, version)
+        if page is not None:
+            return page.response(request, etag)
+
+        def stream_and_cache():
+            # The feed is streamed as it is written, and cached once it was written completely,
+            # so a full copy of it is held until then
+            chunks = []
+            for chunk in iter_google_feed(artwork_data, PROD_WEBSITE):
+                chunks.append(chunk)
+                yield chunk
+            page_cache.put(GOOGLE_FEED_KEY, version, b"".join(chunks), media_type="application/xml")
+
+        return StreamingResponse(
+            stream_and_cache(),
+            media_type="application/xml",
+            headers={"ETag": etag, "Cache-Control": PAGE_CACHE_CONTROL},
+        )
     
     except Exception as e:
         logger.error(f"Error in export_google_feed: {e}")
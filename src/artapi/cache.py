@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Union
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing backend for a while after repeated failures.
+
+    Closed lets every call through. After failure_threshold failures in a row the breaker
+    opens and rejects calls until reset_timeout has passed, then lets a single trial call
+    through (half open). A successful trial closes it again, a failed one re-opens it.
+    """
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Union[float, None] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """
+            Check if a call may go through, in half open state only one caller gets a trial call
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def available(self) -> bool:
+        """
+            Check if a call would go through, without claiming the half open trial
+        """
+        with self._lock:
+            state = self.state
+            return state == "closed" or (state == "half_open" and not self._trial_running)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Union[BaseException, None] = None
+
+
+class SingleFlight:
+    """
+    Run at most one call per key at a time. Callers that arrive while a call for the same
+    key is running wait for it and share its result instead of starting their own.
+    """
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._calls
+
+    def _claim(self, key: Hashable):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = self._calls[key] = _Call()
+            return call, True
+
+    def _run(self, key: Hashable, call: _Call, fn: Callable, *args, **kwargs) -> None:
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """
+            Call fn for key, or wait for the call already running for key
+
+            Returns:
+                Any: The result of the call
+
+            Raises:
+                Exception: The exception raised by the call, re-raised in every waiting caller
+        """
+        call, leader = self._claim(key)
+        if leader:
+            self._run(key, call, fn, *args, **kwargs)
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do_in_background(self, key: Hashable, fn: Callable, *args, **kwargs) -> bool:
+        """
+            Start fn for key in a background thread unless a call for key is already running
+
+            Returns:
+                bool: True if a call was started, False if one was already running
+        """
+        call, leader = self._claim(key)
+        if leader:
+            threading.Thread(target=self._run, args=(key, call, fn, *args), kwargs=kwargs, daemon=True).start()
+        return leader
+
+
+class TTLCache:
+    """
+    Values that expire ttl seconds after they were stored, the least recently used
+    entries are dropped once max_entries is exceeded.
+    """
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -0,0 +1,178 @@
+import gzip
+import zlib
+from typing import Dict, Union
+
+try:
+    import brotli
+except ImportError:  # Optional, responses fall back to gzip
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # Optional, responses fall back to gzip
+    zstandard = None
+
+# Preferred first, only encodings that can be produced here are offered
+SUPPORTED_ENCODINGS = tuple(
+    encoding for encoding, available in (("br", brotli is not None), ("zstd", zstandard is not None), ("gzip", True))
+    if available
+)
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """
+        Compress data with the given content encoding
+
+        Arguments:
+            data (bytes): The data to compress
+            encoding (str): The content encoding, br, zstd or gzip
+            level (int): The compression level, gzip 1-9, brotli 0-11, zstd 1-22
+
+        Returns:
+            bytes: The compressed data
+
+        Raises:
+            ValueError: If the encoding is not supported
+    """
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=level)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data, quality=level)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+class StreamCompressor:
+    """
+    Compress a body sent in chunks, compress() returns what is ready so far and flush() ends the stream
+    """
+    def __init__(self, encoding: str, level: int):
+        if encoding == "gzip":
+            # wbits 31 writes the gzip header and trailer
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self._compress = self._compressor.compress
+            self._flush = self._compressor.flush
+        elif encoding == "br" and brotli is not None:
+            self._compressor = brotli.Compressor(quality=level)
+            self._compress = self._compressor.process
+            self._flush = self._compressor.finish
+        elif encoding == "zstd" and zstandard is not None:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self._compress = self._compressor.compress
+            self._flush = self._compressor.flush
+        else:
+            raise ValueError(f"Unsupported content encoding: {encoding}")
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compress(data)
+
+    def flush(self) -> bytes:
+        return self._flush()
+
+
+class CompressionPolicy:
+    """
+    How responses of a content type are compressed, the encodings in order of preference with their levels
+    """
+    __slots__ = ("levels", "large_levels")
+
+    def __init__(self, levels: Dict[str, int], large_levels: Union[Dict[str, int], None] = None):
+        self.levels = levels
+        # Used for bodies over LARGE_BODY_BYTES, where the time spent matters more than the ratio
+        self.large_levels = large_levels or levels
+
+    @property
+    def encodings(self) -> tuple:
+        return tuple(encoding for encoding in self.levels if encoding in SUPPORTED_ENCODINGS)
+
+    def level(self, encoding: str, size: Union[int, None]) -> int:
+        if size is not None and size > LARGE_BODY_BYTES:
+            return self.large_levels[encoding]
+        return self.levels[encoding]
+
+
+LARGE_BODY_BYTES = 1024 * 1024
+MINIMUM_SIZE = 1000
+
+# Catalog pages are mostly base64 JPEG, which barely compresses, so large pages use the fastest levels
+HTML_POLICY = CompressionPolicy({"br": 4, "zstd": 3, "gzip": 5}, large_levels={"br": 1, "zstd": 1, "gzip": 1})
+TEXT_POLICY = CompressionPolicy({"br": 5, "zstd": 6, "gzip": 6})
+
+# Matched by prefix, the first match wins, content types that match none are sent as they are
+POLICIES = (
+    ("text/html", HTML_POLICY),
+    ("text/", TEXT_POLICY),
+    ("application/json", TEXT_POLICY),
+    ("application/x-ndjson", TEXT_POLICY),
+    ("application/javascript", TEXT_POLICY),
+    ("application/xml", TEXT_POLICY),
+    ("application/rss+xml", TEXT_POLICY),
+    ("image/svg+xml", TEXT_POLICY),
+)
+
+
+def get_policy(content_type: str) -> Union[CompressionPolicy, None]:
+    """
+        Find the compression policy of a content type
+
+        Arguments:
+            content_type (str): The Content-Type header value
+
+        Returns:
+            CompressionPolicy: The policy, None if responses of this type are already compressed or not worth compressing
+    """
+    content_type = content_type.lower()
+    for prefix, policy in POLICIES:
+        if content_type.startswith(prefix):
+            return policy
+    return None
+
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    """
+        Parse an Accept-Encoding header
+
+        Arguments:
+            header (str): The Accept-Encoding header value
+
+        Returns:
+            dict: The q value of every listed encoding, q=0 marks a refused encoding
+    """
+    encodings = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        encodings[name] = q
+    return encodings
+
+
+def choose_encoding(header: str, available=SUPPORTED_ENCODINGS) -> Union[str, None]:
+    """
+        Pick the content encoding to send for an Accept-Encoding header
+
+        Arguments:
+            header (str): The Accept-Encoding header value
+            available (tuple): The encodings that can be sent, most preferred first
+
+        Returns:
+            str: The chosen encoding, None to send the identity body
+    """
+    accepted = accepted_encodings(header)
+    wildcard = accepted.get("*", 0.0)
+    best, best_q = None, 0.0
+    for encoding in available:
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
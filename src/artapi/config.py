@@ -18,7 +18,29 @@ NOCODB_COOKIES_TABLE = os.getenv("nocodb_cookies_table")
 NOCODB_PRODUCT_MAP_TABLE = os.getenv("nocodb_product_map_table")
 NOCODB_ERROR_TABLE = os.getenv("nocodb_error_table")
 
+# Max records sent per NocoDB bulk write request
+NOCODB_BATCH_SIZE = int(os.getenv("nocodb_batch_size", "100"))
+# Max concurrent image downloads from NocoDB storage
+NOCODB_DOWNLOAD_CONCURRENCY = int(os.getenv("nocodb_download_concurrency", "8"))
+# Threads used to resize and encode images, Pillow releases the GIL while doing so
+IMAGE_WORKERS = int(os.getenv("image_workers", str(os.cpu_count() or 2)))
+
 STRIPE_SECRET_KEY = os.getenv("stripe_secret_key")
+# Sends every Stripe call to another server, only for running against benchmarks/fake_stripe.py
+STRIPE_API_BASE = os.getenv("stripe_api_base")
+# Timeout and retries of every Stripe API call, retried POSTs reuse their idempotency key
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("stripe_timeout_seconds", "20"))
+STRIPE_MAX_NETWORK_RETRIES = int(os.getenv("stripe_max_network_retries", "2"))
+# How long a payment link is reused for a checkout with the same cart
+PAYMENT_LINK_TTL_SECONDS = float(os.getenv("payment_link_ttl_seconds", "3600"))
+# Max concurrent Stripe calls while resolving the lines of one checkout
+STRIPE_CONCURRENCY = int(os.getenv("stripe_concurrency", "8"))
+# Signing secret of the webhook endpoint that keeps the local Stripe product mirror current
+STRIPE_WEBHOOK_SECRET = os.getenv("stripe_webhook_secret")
+# Full reconciliation of the mirror, catches webhook deliveries that were missed
+STRIPE_RECONCILE_SECONDS = float(os.getenv("stripe_reconcile_seconds", "900"))
+# How often the catalog is checked for artwork whose Stripe product needs creating or updating
+STRIPE_PROVISION_SECONDS = float(os.getenv("stripe_provision_seconds", "60"))
 
 DEVELOPMENT_ORIGINS = os.getenv("development_origins")
 PRODUCTION_ORIGINS = os.getenv("production_origins")
@@ -26,6 +48,41 @@ DEVELOPMENT_HOSTS = os.getenv("development_hosts")
 PRODUCTION_HOSTS = os.getenv("production_hosts")
 ENVIORNMENT = os.getenv("enviornment")
 
+# Cached artwork data is served right away and re-checked against the database in the background
+ARTWORK_REVALIDATE_SECONDS = float(os.getenv("artwork_revalidate_seconds", "5"))
+# Consecutive refresh failures before refreshes are paused, and how long they stay paused
+REFRESH_FAILURE_THRESHOLD = int(os.getenv("refresh_failure_threshold", "3"))
+REFRESH_RESET_SECONDS = float(os.getenv("refresh_reset_seconds", "30"))
+
+# Memory budget of each worker for rendered catalog pages, raw and compressed bodies combined
+RENDER_CACHE_MAX_BYTES = int(os.getenv("render_cache_max_bytes", str(64 * 1024 * 1024)))
+
+# Local files that let workers start without waiting on NocoDB or Postgres
+CACHE_DIR = os.getenv("cache_dir", "cache")
+# Workers boot from the cached key table, the refresher checks it against NocoDB this often
+KEY_REFRESH_SECONDS = float(os.getenv("key_refresh_seconds", "300"))
+
+# Size and number of the rotated JSON log files in log/
+LOG_MAX_BYTES = int(os.getenv("log_max_bytes", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("log_backup_count", "5"))
+# Bearer token of the /metrics endpoint, the endpoint is disabled while unset
+METRICS_TOKEN = os.getenv("metrics_token")
+# Bearer token of the /logs endpoint, the endpoint is disabled while unset
+LOG_API_TOKEN = os.getenv("log_api_token")
+# Records waiting for the log writer, further records are dropped when it is full
+LOG_QUEUE_SIZE = int(os.getenv("log_queue_size", "10000"))
+# Fraction of requests whose info level access lines are written, errors are always written
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("access_log_sample_rate", "1.0"))
+
+# Warnings and errors are mailed and posted to Telegram in batches, repeats of a message are sent once with a count
+NOTIFY_BATCH_SECONDS = float(os.getenv("notify_batch_seconds", "10"))
+# Max notifications sent per hour, records beyond it wait for the next batch
+NOTIFY_MAX_PER_HOUR = int(os.getenv("notify_max_per_hour", "20"))
+# Records waiting for the notification worker, further records are dropped when it is full
+NOTIFY_QUEUE_SIZE = int(os.getenv("notify_queue_size", "1000"))
+# Timeout of the SMTP and Telegram calls of the notification worker
+NOTIFY_TIMEOUT_SECONDS = float(os.getenv("notify_timeout_seconds", "10"))
+
 DATABASE_URL = os.getenv("database_url")
 SYNC_DATABASE_URL = os.getenv("sync_database_url")
 # Create an instance of TableMap
@@ -10,6 +10,10 @@ def get_artworks(db: Session, skip: int = 0, limit: int = 100):
     db.expire_all()
     return db.query(models.Artwork).offset(skip).limit(limit).all()
 
+def get_artwork_timestamps(db: Session, skip: int = 0, limit: int = 100):
+    db.expire_all()
+    return [(row.id, row.updated_at) for row in db.query(models.Artwork.id, models.Artwork.updated_at).offset(skip).limit(limit).all()]
+
 def get_key(db: Session, key_id: int):
     return db.query(models.Keys).filter(models.Keys.id == key_id).first()
 
@@ -110,4 +114,83 @@ def get_artwork_by_sortorder(db: Session, sortorder: int):
     return db.query(models.Artwork).filter(models.Artwork.sortorder == sortorder).first()
 
 def get_artwork_by_title(db: Session, title: str):
-    return db.query(models.Artwork).filter(models.Artwork.img_label == title).first()
\ No newline at end of file
+    return db.query(models.Artwork).filter(models.Artwork.img_label == title).first()
+
+def count_stripe_products(db: Session) -> int:
+    return db.query(models.StripeProduct).count()
+
+def get_active_stripe_products_by_title(db: Session, titles: list) -> dict:
+    """
+    Map each title to its newest active Stripe product.
+
+    :param db: Database session.
+    :param titles: The product titles to look up.
+    """
+    products = {}
+    rows = (
+        db.query(models.StripeProduct)
+        .filter(models.StripeProduct.title.in_(titles), models.StripeProduct.active.is_(True))
+        .order_by(models.StripeProduct.created.desc())
+        .all()
+    )
+    for row in rows:
+        products.setdefault(row.title, row)
+    return products
+
+def get_active_stripe_prices(db: Session, product_ids: list) -> dict:
+    """
+    Map (product_id, unit_amount) to an active Stripe price id.
+
+    :param db: Database session.
+    :param product_ids: The products whose prices to look up.
+    """
+    rows = (
+        db.query(models.StripePrice)
+        .filter(models.StripePrice.product_id.in_(product_ids), models.StripePrice.active.is_(True))
+        .all()
+    )
+    return {(row.product_id, row.unit_amount): row.price_id for row in rows}
+
+def upsert_stripe_product(db: Session, product_id: str, title: str, default_price_id: str, active: bool, created: int,
+                          image_path: str = None) -> None:
+    try:
+        db.merge(models.StripeProduct(
+            product_id=product_id, title=title, default_price_id=default_price_id, active=active, created=created,
+            image_path=image_path
+        ))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise
+
+def upsert_stripe_price(db: Session, price_id: str, product_id: str, unit_amount: int, active: bool) -> None:
+    try:
+        db.merge(models.StripePrice(price_id=price_id, product_id=product_id, unit_amount=unit_amount, active=active))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise
+
+def replace_stripe_mirror(db: Session, products: list, prices: list) -> None:
+    """
+    Replace the Stripe mirror with a full listing in one transaction, rows missing from the listing are removed.
+
+    :param db: Database session.
+    :param products: StripeProduct rows for every Stripe product.
+    :param prices: StripePrice rows for every Stripe price.
+    """
+    try:
+        for product in products:
+            db.merge(product)
+        for price in prices:
+            db.merge(price)
+        db.query(models.StripeProduct).filter(
+            models.StripeProduct.product_id.notin_([product.product_id for product in products])
+        ).delete(synchronize_session=False)
+        db.query(models.StripePrice).filter(
+            models.StripePrice.price_id.notin_([price.price_id for price in prices])
+        ).delete(synchronize_session=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise
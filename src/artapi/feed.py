@@ -0,0 +1,63 @@
+from typing import Iterator
+from xml.sax.saxutils import escape
+
+from .models import ArtObject
+
+GOOGLE_NAMESPACE = "http://base.google.com/ns/1.0"
+# Items are written out in batches so the response is not sent in thousands of tiny chunks
+ITEMS_PER_CHUNK = 100
+# minidom also wrote double quotes in text as &quot;
+ENTITIES = {'"': "&quot;"}
+
+
+def _element(indent: int, tag: str, text) -> str:
+    return f"{'  ' * indent}<{tag}>{escape(str(text), ENTITIES)}</{tag}>\n"
+
+def _item(record, website: str) -> str:
+    title, price, id = record.title, record.price, record.Id
+    shop_path = str(title).replace(' ', '+')
+    description = f"Large Giclée prints with a half inch white border. Refer to briglightart.com/shop/{shop_path} for more details on specific sizes."
+    return "".join((
+        "    <item>\n",
+        _element(3, "g:id", id),
+        _element(3, "g:title", title),
+        _element(3, "g:brand", "Art Ecommerce LLC"),
+        _element(3, "g:mpn", f"PRINT-{id}"),
+        # If you have GTINs, add a g:gtin element here
+        _element(3, "g:description", description),
+        _element(3, "g:link", f"{website}/shop/{shop_path}"),
+        _element(3, "g:image_link", f"{website}/stream_image/{id}"),
+        _element(3, "g:price", f"{price} USD"),
+        _element(3, "g:condition", "new"),
+        _element(3, "g:availability", "in stock"),
+        "    </item>\n",
+    ))
+
+def iter_google_feed(artwork_data: ArtObject, website: str) -> Iterator[bytes]:
+    """
+        Write the Google Shopping RSS feed one batch of items at a time, only the current batch
+        is held here, callers that keep the chunks hold the whole feed
+
+        Arguments:
+            artwork_data (ArtObject): The artwork to list
+            website (str): The website the item links point to
+
+        Returns:
+            Iterator[bytes]: The UTF-8 encoded feed in chunks
+    """
+    yield "".join((
+        '<?xml version="1.0" ?>\n',
+        f'<rss xmlns:g="{GOOGLE_NAMESPACE}" version="2.0">\n',
+        "  <channel>\n",
+        _element(2, "title", "Brig Light Art"),
+        _element(2, "link", website),
+        _element(2, "description", "Brig Light Art products"),
+    )).encode("utf-8")
+    chunk = []
+    for record in artwork_data:
+        chunk.append(_item(record, website))
+        if len(chunk) >= ITEMS_PER_CHUNK:
+            yield "".join(chunk).encode("utf-8")
+            chunk = []
+    chunk.append("  </channel>\n</rss>\n")
+    yield "".join(chunk).encode("utf-8")
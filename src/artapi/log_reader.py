@@ -0,0 +1,281 @@
+import os
+import re
+import json
+import logging
+from datetime import datetime
+from typing import Iterator, List, Union
+
+# Files are read in blocks of this size when seeking backwards from the end
+CHUNK_SIZE = 64 * 1024
+# Lines written before the log became JSON, asctime - name - levelname - message
+_TEXT_LINE = re.compile(rb"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (\S+) - ([A-Z]+) - (.*)$")
+
+
+def log_files(directory: str, name: str = "app.log", backup_count: int = 5) -> List[str]:
+    """
+        Find the log file and its rotated copies
+
+        Arguments:
+            directory (str): The log directory
+            name (str): The name of the current log file
+            backup_count (int): How many rotated copies are kept
+
+        Returns:
+            list: The paths that exist, oldest first, the current file last
+    """
+    paths = [os.path.join(directory, f"{name}.{i}") for i in range(backup_count, 0, -1)]
+    paths.append(os.path.join(directory, name))
+    return [path for path in paths if os.path.exists(path)]
+
+def parse_line(line: bytes) -> Union[dict, None]:
+    """
+        Parse one log line, JSON lines and the older text lines
+
+        Returns:
+            dict: The entry, None if the line is neither
+    """
+    line = line.rstrip(b"\r\n")
+    if line.startswith(b"{"):
+        try:
+            entry = json.loads(line)
+            entry["_time"] = datetime.fromisoformat(entry["time"])
+            return entry
+        except (ValueError, KeyError, TypeError):
+            return None
+    match = _TEXT_LINE.match(line)
+    if match is None:
+        return None
+    asctime, name, level, message = (part.decode("utf-8", "replace") for part in match.groups())
+    created = datetime.strptime(asctime, "%Y-%m-%d %H:%M:%S,%f").astimezone()
+    return {
+        "time": created.isoformat(timespec="milliseconds"),
+        "level": level,
+        "logger": name,
+        "message": message,
+        "_time": created,
+    }
+
+def line_start_after(f, position: int) -> int:
+    """
+        The offset of the first line that starts at or after a byte position
+    """
+    if position <= 0:
+        return 0
+    f.seek(position - 1)
+    f.readline()
+    return f.tell()
+
+def seek_time(f, size: int, since: datetime) -> int:
+    """
+        Bisect a chronological log file for the first line at or after a time, reading
+        one line per step instead of the whole file
+
+        Arguments:
+            f (BinaryIO): The open log file
+            size (int): The size of the file to search
+            since (datetime): The time to find, timezone aware
+
+        Returns:
+            int: The offset of the first line at or after since, size if there is none
+    """
+    low, high = 0, size
+    while low < high:
+        middle = (low + high) // 2
+        start = line_start_after(f, middle)
+        entry = None
+        f.seek(start)
+        # Lines that can't be parsed are passed over to the next entry
+        while entry is None and f.tell() < size:
+            entry = parse_line(f.readline())
+        if entry is None or entry["_time"] >= since:
+            high = middle
+        else:
+            low = middle + 1
+    return min(line_start_after(f, low), size)
+
+def tail_offset(f, size: int, lines: int) -> int:
+    """
+        Find where the last lines of a file start by reading backwards from the end
+
+        Arguments:
+            f (BinaryIO): The open log file
+            size (int): The size of the file
+            lines (int): How many lines to keep
+
+        Returns:
+            int: The offset of the first of the last lines
+    """
+    if lines <= 0:
+        return size
+    position = size
+    newlines = 0
+    first = True
+    while position > 0:
+        read = min(CHUNK_SIZE, position)
+        position -= read
+        f.seek(position)
+        chunk = f.read(read)
+        if first and chunk.endswith(b"\n"):
+            # The newline that ends the last line doesn't start one
+            chunk = chunk[:-1]
+        first = False
+        index = len(chunk)
+        while True:
+            index = chunk.rfind(b"\n", 0, index)
+            if index < 0:
+                break
+            newlines += 1
+            if newlines == lines:
+                return position + index + 1
+    return 0
+
+def _aware(value: Union[datetime, None]) -> Union[datetime, None]:
+    # Times without a timezone are taken as local time, like the log's own timestamps
+    if value is not None and value.tzinfo is None:
+        return value.astimezone()
+    return value
+
+def _level(entry: dict) -> int:
+    value = logging.getLevelName(entry.get("level", ""))
+    return value if isinstance(value, int) else 0
+
+def iter_logs(
+    paths: List[str],
+    file: Union[str, None] = None,
+    offset: Union[int, None] = None,
+    inode: Union[int, None] = None,
+    since: Union[datetime, None] = None,
+    until: Union[datetime, None] = None,
+    level: Union[str, None] = None,
+    limit: int = 1000,
+    tail: int = 200,
+) -> Iterator[bytes]:
+    """
+        Stream log entries as JSON lines, reading only the part of each file that is needed.
+        Where to start, in order of precedence: the byte offset of a file, the first entry at
+        or after since, or the last tail lines of the current file. The last line is the cursor,
+        {"cursor": {"file": ..., "offset": ..., "inode": ...}}, pass it back to continue where this
+        read stopped. The inode finds the file again after rotation has renamed it.
+
+        Arguments:
+            paths (list): The log files, oldest first, from log_files
+            file (str): The name of the file offset refers to, the current file by default
+            offset (int): The byte offset to continue from
+            inode (int): The inode of the file offset refers to, from the cursor
+            since (datetime): Skip entries before this time
+            until (datetime): Stop at the first entry after this time
+            level (str): Skip entries below this level
+            limit (int): Max entries returned
+            tail (int): How many lines of the current file to start with when there is no offset or since
+
+        Returns:
+            Iterator[bytes]: The entries, one JSON object per line, followed by the cursor
+
+        Raises:
+            ValueError: If the file or level is unknown
+    """
+    names = [os.path.basename(path) for path in paths]
+    min_level = 0
+    if level is not None:
+        min_level = logging.getLevelName(level.upper())
+        if not isinstance(min_level, int):
+            raise ValueError(f"Unknown log level: {level}")
+    since, until = _aware(since), _aware(until)
+    filtered = level is not None or since is not None or until is not None
+    if not paths:
+        return iter([_cursor(file, 0, None)])
+    if file is not None and file not in names:
+        raise ValueError(f"Unknown log file: {file}")
+
+    # Pick the file and position to start from
+    index = len(paths) - 1
+    position = None
+    if offset is not None:
+        index = names.index(file) if file is not None else index
+        position = offset
+        if inode is not None:
+            # Rotation renames the files, the cursor's file is wherever its inode is now
+            index = next((i for i, path in enumerate(paths) if os.stat(path).st_ino == inode), None)
+            if index is None:
+                # Rotated out of the kept copies, continue with the oldest one left
+                index, position = 0, 0
+        if position > os.path.getsize(paths[index]):
+            # Not the file the offset was taken in
+            position = 0
+    elif since is not None:
+        # Files last written before since hold nothing newer
+        index = next((i for i, path in enumerate(paths) if datetime.fromtimestamp(os.path.getmtime(path)).astimezone() >= since), None)
+        if index is None:
+            index, position = len(paths) - 1, os.path.getsize(paths[-1])
+    return _batched(_read_entries(paths, index, position, since, until, min_level, filtered, limit, tail))
+
+def _batched(lines: Iterator[bytes]) -> Iterator[bytes]:
+    # Sent in blocks of about CHUNK_SIZE rather than one line per chunk
+    batch, size = [], 0
+    for line in lines:
+        batch.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield b"".join(batch)
+            batch, size = [], 0
+    if batch:
+        yield b"".join(batch)
+
+def _cursor(file: Union[str, None], offset: int, inode: Union[int, None]) -> bytes:
+    return (json.dumps({"cursor": {"file": file, "offset": offset, "inode": inode}}) + "\n").encode("utf-8")
+
+def _read_entries(paths: List[str], index: int, position: Union[int, None], since, until, min_level: int, filtered: bool, limit: int, tail: int) -> Iterator[bytes]:
+    count = 0
+    done = False
+    for current in range(index, len(paths)):
+        with open(paths[current], "rb") as f:
+            # Lines written after this point are left for the next read
+            stat = os.fstat(f.fileno())
+            size, inode = stat.st_size, stat.st_ino
+            if position is None:
+                position = seek_time(f, size, since) if since is not None else tail_offset(f, size, tail)
+            # A cursor that doesn't fall on a line start continues with the next whole line
+            position = min(line_start_after(f, min(position, size)), size)
+            f.seek(position)
+            while position < size:
+                line = f.readline()
+                if not line.endswith(b"\n") or position + len(line) > size:
+                    # A line still being written
+                    break
+                entry = parse_line(line) if filtered or not line.startswith(b"{") else None
+                if until is not None and entry is not None and entry["_time"] > until:
+                    done = True
+                    break
+                position += len(line)
+                if filtered and (
+                    entry is None
+                    or (since is not None and entry["_time"] < since)
+                    or _level(entry) < min_level
+                ):
+                    continue
+                if line.startswith(b"{"):
+                    yield line
+                elif entry is not None:
+                    entry.pop("_time")
+                    yield (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+                else:
+                    yield (json.dumps({"message": line.rstrip(b"\r\n").decode("utf-8", "replace")}, ensure_ascii=False) + "\n").encode("utf-8")
+                count += 1
+                if count >= limit:
+                    done = True
+                    break
+        if done or current == len(paths) - 1:
+            break
+        position = 0
+    yield _cursor(os.path.basename(paths[current]), position, inode)
+
+def tail_lines(path: str, lines: int) -> str:
+    """
+        Read the last lines of a file without reading the rest of it
+    """
+    if not os.path.exists(path):
+        return ""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        f.seek(tail_offset(f, size, lines))
+        return f.read(size - f.tell()).decode("utf-8", "replace")
@@ -1,12 +1,21 @@
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import copy
+import json
+import time
+import queue
+import atexit
+import random
+import contextvars
+from collections import OrderedDict, deque
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from datetime import datetime
+from typing import Union
 import smtplib
 from email.mime.text import MIMEText
 import requests
 from src.artapi.noco_config import (
-    ADMIN_DEVELOPER_EMAIL, 
+    ADMIN_DEVELOPER_EMAIL,
     ADMIN_DEVELOPER_NUMBER,
     SMTP_SERVER,
     SMTP_PORT,
@@ -14,27 +23,112 @@ from src.artapi.noco_config import (
     ERROR405_BOT_TOKEN,
     ERROR405_CHAT_ID
 )
+from src.artapi.log_reader import tail_lines
+from src.artapi.config import (
+    LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_QUEUE_SIZE, ACCESS_LOG_SAMPLE_RATE,
+    NOTIFY_BATCH_SECONDS, NOTIFY_MAX_PER_HOUR, NOTIFY_QUEUE_SIZE, NOTIFY_TIMEOUT_SECONDS
+)
 
 # Ensure the log directory exists
 log_dir = "log"
 os.makedirs(log_dir, exist_ok=True)
 
+# Request lines, sampled by ACCESS_LOG_SAMPLE_RATE
+ACCESS_LOGGER = "brig_api.access"
+# Extra fields of access records that are written to the JSON log
+ACCESS_FIELDS = ("method", "path", "status", "duration_ms", "bytes", "client")
+LOG_BUFFER_BYTES = 64 * 1024
+# Whether the current request's access lines are written, set per request by the logging middleware
+access_sampled = contextvars.ContextVar("access_sampled", default=True)
+
+# Distinct messages kept per batch, further ones are only counted
+MAX_PENDING_MESSAGES = 100
+# Telegram rejects longer messages
+TELEGRAM_MAX_LENGTH = 4096
+# Formats the tracebacks of queued records
+_EXCEPTION_FORMATTER = logging.Formatter()
+
 class ErrorLogger(logging.Handler):
-    def __init__(self) -> None:
-        super().__init__() 
-    
+    """
+    Notifies the developer of warnings and errors by email and Telegram. It runs on the
+    notification worker, records are collected for NOTIFY_BATCH_SECONDS, repeats of a message
+    are sent once with a count, and at most NOTIFY_MAX_PER_HOUR notifications go out.
+    """
+    def __init__(self, batch_seconds: float = NOTIFY_BATCH_SECONDS, max_per_hour: int = NOTIFY_MAX_PER_HOUR) -> None:
+        super().__init__()
+        self.batch_seconds = batch_seconds
+        self.max_per_hour = max_per_hour
+        # (level, logger name, message) -> [count, first record]
+        self.pending = OrderedDict()
+        self.dropped = 0
+        self.batch_started = None
+        self.sent_at = deque()
+        self.smtp = None
+        self.session = requests.Session()
+
     def emit(self, record: logging.LogRecord) -> None:
         if record.levelno > logging.INFO:  # Post only warnings, errors, and critical logs
-            payload = self.format_payload(record)
-            self.send_email(payload)
-            self.send_telegram_message(payload)
-    
+            key = (record.levelname, record.name, record.getMessage())
+            if key in self.pending:
+                self.pending[key][0] += 1
+            elif len(self.pending) < MAX_PENDING_MESSAGES:
+                self.pending[key] = [1, record]
+            else:
+                self.dropped += 1
+            if self.batch_started is None:
+                self.batch_started = time.monotonic()
+
+    def seconds_until_flush(self) -> Union[float, None]:
+        """
+            How long until the pending batch is due, None if nothing is pending
+        """
+        if self.batch_started is None:
+            return None
+        due = self.batch_started + self.batch_seconds
+        if len(self.sent_at) >= self.max_per_hour:
+            due = max(due, self.sent_at[0] + 3600)
+        return max(due - time.monotonic(), 0.0)
+
+    def flush(self) -> None:
+        """
+            Send the pending batch if it is due and the hourly limit allows it
+        """
+        now = time.monotonic()
+        while self.sent_at and self.sent_at[0] <= now - 3600:
+            self.sent_at.popleft()
+        if self.seconds_until_flush() != 0.0:
+            return
+        payload = self.format_batch_payload()
+        self.pending.clear()
+        self.dropped = 0
+        self.batch_started = None
+        self.sent_at.append(now)
+        self.send_email(payload)
+        self.send_telegram_message(payload)
+
+    def close(self) -> None:
+        # Whatever is pending at shutdown is sent regardless of the batch window
+        if self.pending:
+            self.batch_started = time.monotonic() - self.batch_seconds
+            self.sent_at.clear()
+            self.flush()
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except:
+                pass
+            self.smtp = None
+        super().close()
+
     def format_payload(self, record: logging.LogRecord) -> dict:
+        message = record.getMessage()
+        if record.exc_text:
+            message = f"{message}\n{record.exc_text}"
         error = {
             "timestamp": self.format_time(record),
             "logger_name": record.name,
             "level": record.levelname,
-            "message": record.getMessage()
+            "message": message
         }
         ticket_assignment = {
             "developer_email": ADMIN_DEVELOPER_EMAIL,
@@ -51,10 +145,61 @@ class ErrorLogger(logging.Handler):
 
         return payload
 
+    def format_batch_payload(self) -> dict:
+        """
+            Build one payload for the pending batch, the first occurrence of each message with its count
+
+            Returns:
+                dict: The payload, with the highest level of the batch and a summary line per message
+        """
+        payloads = [(count, self.format_payload(record)) for count, record in self.pending.values()]
+        levelno = max(record.levelno for _, record in self.pending.values())
+        lines = []
+        for count, payload in payloads:
+            error = payload["error"]
+            repeated = f" (x{count})" if count > 1 else ""
+            lines.append(f"{error['timestamp']} {error['level']} {error['message']}{repeated}")
+        if self.dropped:
+            lines.append(f"{self.dropped} more records with other messages")
+        return {
+            "error": {
+                "timestamp": payloads[0][1]["error"]["timestamp"],
+                "logger_name": payloads[0][1]["error"]["logger_name"],
+                "level": logging.getLevelName(levelno),
+                "message": "\n".join(lines),
+                "count": sum(count for count, _ in payloads) + self.dropped,
+            },
+            "ticket_assignment": payloads[0][1]["ticket_assignment"],
+            "status": "open",
+        }
+
     def format_time(self, record: logging.LogRecord) -> str:
         record_time = datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S')
         return record_time
 
+    def smtp_connection(self) -> smtplib.SMTP:
+        # The connection is kept between batches and only reopened once the server has dropped it
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            try:
+                self.smtp.close()
+            except:
+                pass
+            self.smtp = None
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=NOTIFY_TIMEOUT_SECONDS)
+        try:
+            server.starttls()
+            server.login(ADMIN_DEVELOPER_EMAIL, APP_PASSWORD)
+        except:
+            server.close()
+            raise
+        self.smtp = server
+        return server
+
     def send_email(self, payload: dict) -> None:
         try:
             message = MIMEText(f"Error occurred:\n\n{payload['error']}")
@@ -62,10 +207,12 @@ class ErrorLogger(logging.Handler):
             message['From'] = ADMIN_DEVELOPER_EMAIL
             message['To'] = ADMIN_DEVELOPER_EMAIL
 
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                server.starttls()
-                server.login(ADMIN_DEVELOPER_EMAIL, APP_PASSWORD)
-                server.sendmail(ADMIN_DEVELOPER_EMAIL, ADMIN_DEVELOPER_EMAIL, message.as_string())
+            try:
+                self.smtp_connection().sendmail(ADMIN_DEVELOPER_EMAIL, ADMIN_DEVELOPER_EMAIL, message.as_string())
+            except smtplib.SMTPServerDisconnected:
+                # Dropped between the NOOP and the send, one retry on a new connection
+                self.smtp = None
+                self.smtp_connection().sendmail(ADMIN_DEVELOPER_EMAIL, ADMIN_DEVELOPER_EMAIL, message.as_string())
         except:
             pass
 
@@ -75,36 +222,211 @@ class ErrorLogger(logging.Handler):
             message = f"Error occurred:\n{payload['error']['timestamp']}\n{payload['error']['message']}"
             data = {
                 'chat_id': ERROR405_CHAT_ID,
-                'text': message
+                'text': message[:TELEGRAM_MAX_LENGTH]
             }
-            response = requests.post(url, json=data)
+            response = self.session.post(url, json=data, timeout=NOTIFY_TIMEOUT_SECONDS)
             response.raise_for_status()
         except:
             pass
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line, with the request fields of access records
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ACCESS_FIELDS:
+            value = record.__dict__.get(field)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that writes through a large buffer. emit() no longer flushes every record,
+    the log worker flushes once it has written everything that was queued. The file size is
+    tracked from the bytes written, asking the stream for its position would flush the buffer
+    on every record.
+    """
+    def __init__(self, *args, buffer_size: int = LOG_BUFFER_BYTES, **kwargs):
+        self.buffer_size = buffer_size
+        self.bytes_written = 0
+        super().__init__(*args, **kwargs)
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, buffering=self.buffer_size, encoding=self.encoding, errors=self.errors)
+        self.bytes_written = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def rolls_over(self, size: int) -> bool:
+        # An empty file takes the record however large it is
+        return self.maxBytes > 0 and self.bytes_written > 0 and self.bytes_written + size >= self.maxBytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        return self.rolls_over(len(self.format(record).encode(self.encoding or "utf-8", self.errors or "strict")) + 1)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # Formatted once, the line that decides the rollover is the line written
+        try:
+            line = self.format(record) + self.terminator
+            size = len(line.encode(self.encoding or "utf-8", self.errors or "strict"))
+            if self.rolls_over(size):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(line)
+            self.bytes_written += size
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        pass
+
+    def flush_buffer(self) -> None:
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.flush()
+                # Other workers append to the same file, their lines count towards the size too
+                self.bytes_written = os.fstat(self.stream.fileno()).st_size
+        finally:
+            self.release()
+
+class AccessSampler(logging.Filter):
+    """
+    Keeps the info level access lines of a sampled share of requests, the decision is made once
+    per request so a request's lines are kept or dropped together. Warnings, errors and failed
+    requests are always kept.
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.INFO or access_sampled.get() or record.__dict__.get("status", 0) >= 500
+
+def sample_access() -> contextvars.Token:
+    """
+        Decide whether the access lines of the current request are written
+
+        Returns:
+            contextvars.Token: Restores the previous decision when passed to access_sampled.reset
+    """
+    return access_sampled.set(ACCESS_LOG_SAMPLE_RATE >= 1.0 or random.random() < ACCESS_LOG_SAMPLE_RATE)
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to a background worker, the logging call only pays for a queue put
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Unlike QueueHandler.prepare the traceback is kept in exc_text instead of being appended
+        # to the message, the JSON log writes it as its own field
+        if record.exc_info and not record.exc_text:
+            record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # A burst drops records rather than blocking requests or growing memory
+            pass
+
+class LogListener(QueueListener):
+    """
+    The log writer, flushes the buffered files whenever it has caught up with the queue
+    """
+    def dequeue(self, block: bool):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush_buffer()
+            return self.queue.get(block)
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        super().stop()
+        for handler in self.handlers:
+            handler.close()
+
+class NotificationListener(QueueListener):
+    """
+    The notification worker, waits for records only until the pending batch is due so it is
+    sent even when no further records arrive
+    """
+    def __init__(self, record_queue: queue.Queue, error_logger: ErrorLogger):
+        super().__init__(record_queue, error_logger)
+        self.error_logger = error_logger
+
+    def dequeue(self, block: bool):
+        while True:
+            try:
+                return self.queue.get(block, self.error_logger.seconds_until_flush())
+            except queue.Empty:
+                self.error_logger.flush()
+
+    def handle(self, record: logging.LogRecord) -> None:
+        super().handle(record)
+        self.error_logger.flush()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        super().stop()
+        self.error_logger.close()
+
+log_listener = None
+notification_listener = None
+
 # Function to setup the logger with the NocoDB connection
 def setup_logger() -> logging.Logger:
+    global log_listener, notification_listener
     logger = logging.getLogger("brig_api")
     logger.setLevel(logging.INFO)
+    if log_listener is not None:
+        return logger
 
-    # Log to a file, with rotation
+    # Log to a file as JSON lines, with rotation, written by a background worker
     log_file = os.path.join(log_dir, "app.log")
-    file_handler = RotatingFileHandler(log_file, maxBytes=2000, backupCount=5)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    file_handler = BufferedRotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter())
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    logger.addHandler(NonBlockingQueueHandler(log_queue))
+    log_listener = LogListener(log_queue, file_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
 
-    # Add custom error logger to the main logger
-    error_logger = ErrorLogger()
-    logger.addHandler(error_logger)
+    # Request lines of the access logger are sampled
+    logging.getLogger(ACCESS_LOGGER).addFilter(AccessSampler())
+
+    # Warnings and errors go to the developer from a background worker
+    record_queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(record_queue)
+    queue_handler.setLevel(logging.WARNING)
+    logger.addHandler(queue_handler)
+    notification_listener = NotificationListener(record_queue, ErrorLogger())
+    notification_listener.start()
+    atexit.register(notification_listener.stop)
 
     return logger
 
 # Initialize logger with a callable that provides the NocoDB connection
 # Function to retrieve logs
-def get_logs() -> str:
-    log_file = os.path.join(log_dir, "app.log")
-    if not os.path.exists(log_file):
-        with open(log_file, "w") as f:
-            f.write("")
-    with open(log_file, "r") as f:
-        return f.read()
+def get_logs(lines: int = 500) -> str:
+    # Only the end of the file is read, older entries are available from the /logs endpoint
+    return tail_lines(os.path.join(log_dir, "app.log"), lines)
@@ -1,21 +1,29 @@
+import time
+import logging
+
 from fastapi import FastAPI
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.httpsredirect import HTTPSRedirectMiddleware
-from starlette.middleware.gzip import GZipMiddleware
 from starlette.middleware.trustedhost import TrustedHostMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from starlette.responses import Response
+from starlette.datastructures import Headers
 from starlette.types import ASGIApp, Receive, Scope, Send
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
 from .noco_config import MIDDLEWARE_STRING
+from .compression import MINIMUM_SIZE, StreamCompressor, choose_encoding, compress, get_policy
+from .metrics import registry
+from .logger import ACCESS_LOGGER, access_sampled, sample_access
 from .config import DEVELOPMENT_ORIGINS, PRODUCTION_ORIGINS, ENVIORNMENT, CSP_POLICY, DEVELOPMENT_HOSTS, PRODUCTION_HOSTS
 from starlette.datastructures import MutableHeaders
 
+access_logger = logging.getLogger(ACCESS_LOGGER)
+
 # Initialize the Limiter
 limiter = Limiter(key_func=get_remote_address)
 
@@ -34,18 +42,43 @@ limiter = Limiter(key_func=get_remote_address)
 #         return self.app(scope, receive, send_wrapper)
 
 class LoggingMiddleware:
+    """
+    Writes one structured access record per request, with its status, size and duration
+    """
     def __init__(self, app: ASGIApp):
         self.app = app
 
-    def __call__(self, scope: Scope, receive: Receive, send: Send):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        token = sample_access()
+        started = time.perf_counter()
+        response = {"status": 500, "bytes": 0}
+
         async def send_wrapper(message):
-            try:
-                await send(message)
-            except Exception as e:
-                # Log the error if needed
-                raise e
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
 
-        return self.app(scope, receive, send_wrapper)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            client = scope.get("client")
+            access_logger.info(
+                "%s %s %s", scope["method"], scope["path"], response["status"],
+                extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": response["status"],
+                    "bytes": response["bytes"],
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+                    "client": client[0] if client else None,
+                },
+            )
+            access_sampled.reset(token)
 
 class SecurityHeadersMiddleware:
     def __init__(self, app: ASGIApp):
@@ -61,6 +94,118 @@ class SecurityHeadersMiddleware:
             await send(message)
 
         return self.app(scope, receive, send_wrapper)
+
+COMPRESSION_SECONDS = registry.histogram(
+    "http_response_compression_seconds", "Time spent compressing one response body"
+)
+COMPRESSION_BYTES_IN = registry.counter("http_response_compression_bytes_in_total", "Response bytes before compression")
+COMPRESSION_BYTES_OUT = registry.counter("http_response_compression_bytes_out_total", "Response bytes after compression")
+
+class CompressionMiddleware:
+    """
+    Compress responses with the encoding and level the compression policy of their content type asks for.
+    Responses that already carry a Content-Encoding, like cached pages and static assets, and content
+    types without a policy, like images, are sent as they are.
+    """
+    def __init__(self, app: ASGIApp, minimum_size: int = MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+        if not accept_encoding:
+            await self.app(scope, receive, send)
+            return
+        await CompressionResponder(self.app, accept_encoding, self.minimum_size)(scope, receive, send)
+
+class CompressionResponder:
+    def __init__(self, app: ASGIApp, accept_encoding: str, minimum_size: int):
+        self.app = app
+        self.accept_encoding = accept_encoding
+        self.minimum_size = minimum_size
+        self.send: Send = None
+        self.start_message = None
+        self.started = False
+        self.passthrough = False
+        self.compressor: StreamCompressor = None
+        self.labels = {}
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    def _compress(self, fn, data: bytes) -> bytes:
+        started = time.perf_counter()
+        compressed = fn(data)
+        self.seconds += time.perf_counter() - started
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def _record(self) -> None:
+        COMPRESSION_SECONDS.observe(self.seconds, **self.labels)
+        COMPRESSION_BYTES_IN.inc(self.bytes_in, **self.labels)
+        COMPRESSION_BYTES_OUT.inc(self.bytes_out, **self.labels)
+
+    async def send_compressed(self, message: dict):
+        if message["type"] == "http.response.start":
+            # Held back until the first body chunk shows whether the body is worth compressing
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if not self.started:
+            self.started = True
+            headers = MutableHeaders(scope=self.start_message)
+            content_type = headers.get("content-type", "")
+            policy = get_policy(content_type)
+            if policy is None or "content-encoding" in headers:
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+            headers.add_vary_header("Accept-Encoding")
+            encoding = choose_encoding(self.accept_encoding, policy.encodings)
+            if encoding is None or (not more_body and len(body) < self.minimum_size):
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+
+            self.labels = {"encoding": encoding, "content_type": content_type.split(";")[0].strip()}
+            headers["Content-Encoding"] = encoding
+            if not more_body:
+                level = policy.level(encoding, len(body))
+                body = self._compress(lambda data: compress(data, encoding, level), body)
+                headers["Content-Length"] = str(len(body))
+                self._record()
+                await self.send(self.start_message)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+
+            # Streamed body, the length is only known when it is done
+            content_length = headers.get("content-length")
+            level = policy.level(encoding, int(content_length) if content_length and content_length.isdigit() else None)
+            del headers["Content-Length"]
+            self.compressor = StreamCompressor(encoding, level)
+            await self.send(self.start_message)
+
+        chunk = self._compress(self.compressor.compress, body)
+        if not more_body:
+            chunk += self._compress(lambda _: self.compressor.flush(), b"")
+            self._record()
+        await self.send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
 def get_allowed_origins() -> list:
     """Get the list of allowed origins based on the environment."""
     if ENVIORNMENT == "production":
@@ -107,11 +252,7 @@ def add_middleware(app: FastAPI):
         allowed_hosts=get_allowed_hosts()
     )
 
-    app.add_middleware(
-        GZipMiddleware,
-        minimum_size=1000,
-        compresslevel=9,
-    )
+    app.add_middleware(CompressionMiddleware)
     # app.add_middleware(
     #     ContentSecurityPolicyMiddleware,
     #     csp_policy=CSP_POLICY
@@ -1,12 +1,14 @@
 # app/models.py
+import ast
+import hashlib
 from pydantic import BaseModel
 from typing import List, Union, Dict, Any
-from dataclasses import dataclass
-from sqlalchemy import Column, Integer, String, DateTime, JSON
+from dataclasses import dataclass, field
+from sqlalchemy import Column, Integer, String, DateTime, JSON, Boolean
 from sqlalchemy.sql import func
 from datetime import datetime
 from dataclasses import dataclass
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Union, Iterable, Iterator
 
 from .postgres import Base
 
@@ -54,6 +56,30 @@ class Cookies(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), onupdate=func.now(), nullable=False)
 
+class StripeProduct(Base):
+    # Local mirror of the Stripe products, kept current by webhooks and periodic reconciliation
+    __tablename__ = "stripe_products"
+
+    product_id = Column(String, primary_key=True)
+    title = Column(String, index=True)
+    default_price_id = Column(String, nullable=True)
+    # NocoDB path of the artwork image the product images were made from, kept in the product metadata
+    image_path = Column(String, nullable=True)
+    active = Column(Boolean, default=True)
+    # Stripe creation time, the newest active product wins when titles repeat
+    created = Column(Integer)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class StripePrice(Base):
+    # Local mirror of the Stripe prices
+    __tablename__ = "stripe_prices"
+
+    price_id = Column(String, primary_key=True)
+    product_id = Column(String, index=True)
+    unit_amount = Column(Integer, nullable=True)
+    active = Column(Boolean, default=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
 class TitleQuantity(BaseModel):
     quantity: Union[int, str]
     title: str
@@ -71,31 +97,111 @@ class ShopObject:
     price: Union[int, str]
     logo : str
 
-# Dataclass to turn list of strings into a list of objects
-@dataclass()
-class IconObject:
-    Ids: List[int]
-    icon_paths: List[str] = None
-    titles: List[str] = None
-    data_uris: List[str] = None
-    created_ats: List[datetime] = None
-    updated_ats: List[datetime] = None
+class IconRecord:
+    """
+    One icon in the catalog snapshot
+    """
+    # Constructor argument order, also the column order of the catalog snapshot
+    FIELDS = ("Id", "title", "icon_path", "data_uri", "created_at", "updated_at")
+    __slots__ = ("Id", "title", "icon_path", "_data_uri", "created_at", "updated_at")
 
-@dataclass()
-class ArtObject:
-    Ids: List[int]
-    # Update so no need for art_paths and just use datauris
-    art_paths : List[str] = None
-    titles: List[str] = None
-    prices: List[Union[int, str]] = None
-    sortorders: List[int] = None
-    data_uris: List[str] = None
-    heights: List[str] = None
-    widths: List[str] = None
-    sortorder: List[int] = None
-    created_ats: List[datetime] = None
-    updated_ats: List[datetime] = None
+    def __init__(self, Id: int, title: str, icon_path: str, data_uri: str, created_at: datetime, updated_at: datetime):
+        self.Id = Id
+        self.title = title
+        self.icon_path = icon_path
+        self._data_uri = data_uri
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    @property
+    def data_uri(self) -> str:
+        # Either a str or a span of the memory mapped catalog snapshot, empty when there is none
+        return str(self._data_uri) if self._data_uri is not None else ""
+
+class ArtRecord:
+    """
+    One artwork in the catalog snapshot
+    """
+    # Constructor argument order, also the column order of the catalog snapshot
+    FIELDS = ("Id", "title", "art_path", "price", "sortorder", "data_uri", "height", "width", "created_at", "updated_at")
+    __slots__ = ("Id", "title", "art_path", "price", "sortorder", "_data_uri", "height", "width", "created_at", "updated_at")
+
+    def __init__(self, Id: int, title: str, art_path: str, price: Union[int, str], sortorder: Union[int, None],
+                 data_uri: str, height: str, width: str, created_at: datetime, updated_at: datetime):
+        self.Id = Id
+        self.title = title
+        self.art_path = art_path
+        self.price = price
+        self.sortorder = sortorder
+        self._data_uri = data_uri
+        self.height = height
+        self.width = width
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    @property
+    def data_uri(self) -> str:
+        # Either a str or a span of the memory mapped catalog snapshot, empty when there is none
+        return str(self._data_uri) if self._data_uri is not None else ""
 
+    @classmethod
+    def from_row(cls, row: Artwork) -> "ArtRecord":
+        return cls(
+            row.id, row.img_label, ast.literal_eval(row.img)[0]['path'], row.price, row.sortorder,
+            row.uri, row.height, row.width, row.created_at, row.updated_at,
+        )
+
+class CatalogObject:
+    """
+    Immutable set of catalog records indexed by title
+    """
+    __slots__ = ("records", "_by_title", "_version")
+
+    def __init__(self, records: Iterable):
+        self.records = tuple(records)
+        self._by_title = {record.title: record for record in self.records}
+        self._version = None
+
+    def __iter__(self) -> Iterator:
+        return iter(self.records)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, title: str) -> bool:
+        return title in self._by_title
+
+    def get(self, title: str):
+        return self._by_title.get(title)
+
+    def timestamps(self) -> Dict[int, datetime]:
+        return {record.Id: record.updated_at for record in self.records}
+
+    @property
+    def version(self) -> str:
+        # Changes whenever a record is added, removed or updated
+        if self._version is None:
+            stamps = sorted((record.Id, str(record.updated_at)) for record in self.records)
+            self._version = hashlib.sha1(repr(stamps).encode("utf-8")).hexdigest()[:16]
+        return self._version
+
+class IconObject(CatalogObject):
+    __slots__ = ()
+    record_type = IconRecord
+
+class ArtObject(CatalogObject):
+    """
+    Artwork snapshot, records are kept in display order (by sortorder)
+    """
+    __slots__ = ()
+    record_type = ArtRecord
+
+    def __init__(self, records: Iterable[ArtRecord]):
+        super().__init__(sorted(records, key=lambda record: (record.sortorder is None, record.sortorder or 0)))
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Artwork]) -> "ArtObject":
+        return cls(ArtRecord.from_row(row) for row in rows)
 
 @dataclass()
 class KeyObject:
@@ -126,6 +232,19 @@ class ErrorObject:
     created_ats: List[datetime] = None
     updated_ats: List[datetime] = None
     
+@dataclass()
+class BulkWriteResult:
+    # Rows returned by NocoDB for the batches that were written
+    succeeded: List[Dict[str, Any]] = field(default_factory=list)
+    # Records from batches that failed, with one error message per failed batch
+    failed: List[Dict[str, Any]] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+    requests: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
 @dataclass
 class TableMap:
     img_table: str
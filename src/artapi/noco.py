@@ -1,24 +1,31 @@
 import base64
 import requests
-from PIL import Image
-from io import BytesIO
+from requests.adapters import HTTPAdapter
 from typing import Union
 import time
 import datetime as dt
 from datetime import datetime, timezone
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import ast
+import logging
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import SQLAlchemyError
 
 from .config import (
-    NOCODB_XC_TOKEN, NOCODB_PATH
+    NOCODB_XC_TOKEN, NOCODB_PATH, NOCODB_BATCH_SIZE,
+    NOCODB_DOWNLOAD_CONCURRENCY, IMAGE_WORKERS, ARTWORK_REVALIDATE_SECONDS,
+    REFRESH_FAILURE_THRESHOLD, REFRESH_RESET_SECONDS
 )
 from .models import (
-    ArtObject, IconObject, KeyObject, CookieObject, ProductMapObject
+    ArtObject, IconObject, IconRecord, KeyObject, CookieObject, ProductMapObject, BulkWriteResult
 )
-from . import crud
+from . import crud, snapshot, utils
+from .cache import CircuitBreaker, SingleFlight
+from .postgres import SessionLocal
 from .tables import NOCODB_TABLE_MAP
 
+logger = logging.getLogger("brig_api")
+
 class CachedData:
 
     def __init__(self):
@@ -35,10 +42,23 @@ class Noco:
     def __init__(self):
         # Caching updates
         self.previous_data = CachedData()
+        # Time the artwork data was last confirmed against the database
+        self.artwork_refreshed_at: Union[float, None] = None
+        # Stops refreshes from hammering a failing database, cached data is served meanwhile
+        self.artwork_breaker = CircuitBreaker(REFRESH_FAILURE_THRESHOLD, REFRESH_RESET_SECONDS)
+        # One load or refresh per cache key at a time, other requests wait on it or serve cached data
+        self.flights = SingleFlight()
+        # The snapshot file the cached data was mapped from, followers remap when it changes
+        self.snapshot_version: Union[tuple, None] = None
         self.resolution_factor = 0.8
         self.cookie_session_time_limit = 60*15
         # Requests for noco
         self.request = requests
+        # Keep-alive pool for image downloads, sized for concurrent fetches
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=NOCODB_DOWNLOAD_CONCURRENCY)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         self.headers = {'xc-token': NOCODB_XC_TOKEN}
         self.base_url = NOCODB_PATH
 
@@ -142,28 +162,101 @@ class Noco:
         except:
             raise
 
+    def send_nocodb_table_data_bulk(self, method: str, table: str, records: list, batch_size: int = None) -> BulkWriteResult:
+        """
+            Send records to a table in batches, NocoDB v2 accepts a list of records per request
+
+            Arguments:
+                method (str): The HTTP method to use, one of post, patch or delete.
+                table (str): The name of the table to write to.
+                records (list): The records to write to the table.
+                batch_size (int): The max number of records per request, defaults to NOCODB_BATCH_SIZE.
+
+            Returns:
+                BulkWriteResult: The rows written and the records of every batch that failed
+        """
+        batch_size = batch_size or NOCODB_BATCH_SIZE
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        send = getattr(self.request, method)
+        result = BulkWriteResult()
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start + batch_size]
+            result.requests += 1
+            try:
+                response = send(self.get_nocodb_path(table), json=batch, headers=self.get_auth_headers())
+                response.raise_for_status()
+                rows = response.json()
+                result.succeeded.extend(rows if isinstance(rows, list) else [rows])
+            except Exception as e:
+                # Keep going so one bad batch does not block the rest of the records
+                result.failed.extend(batch)
+                result.errors.append(f"{method} records {start}-{start + len(batch) - 1}: {e}")
+        return result
+
+    def delete_noco_table_data_bulk(self, table: str, record_ids: list, batch_size: int = None) -> BulkWriteResult:
+        """
+            Function to delete many records from a table in batches
+
+            Arguments:
+                table (str): The name of the table to delete data from.
+                record_ids (list): The IDs of the records to delete from the table.
+                batch_size (int): The max number of records per request.
+
+            Returns:
+                BulkWriteResult: The rows deleted and the records that failed
+        """
+        records = [{"Id": record_id} for record_id in record_ids]
+        return self.send_nocodb_table_data_bulk("delete", table, records, batch_size)
+
+    def download_image(self, path: str) -> bytes:
+        """
+            Download an image from NocoDB storage
+
+            Arguments:
+                path (str): The storage path of the image
+
+            Returns:
+                bytes: The raw image data
+
+            Raises:
+                Exception: If there is an error downloading the image
+        """
+        try:
+            response = self.session.get(f"{self.base_url}/{path}")
+            response.raise_for_status()
+            return response.content
+        except:
+            raise
+
     def convert_paths_to_data_uris(self, paths: list) -> list:
         """
 
             Convert a list of image paths to a list of data URIs
 
+            Downloads run concurrently, bounded by NOCODB_DOWNLOAD_CONCURRENCY, and each image
+            is handed to a resize pool as soon as it arrives, so the total time is close to the
+            slowest single image instead of the sum of all of them.
+
             Arguments:
                 paths (list): A list of image paths to convert
 
             Returns:
-                list: A list of data URIs of the image paths
+                list: A list of data URIs of the image paths, in the same order as the paths
 
             Raises:
                 Exception: If there is an error converting the image paths to data URIs
         """
         try:
-            data_uris = []
-            for path in paths:
-                url_path = f"{self.base_url}/{path}"
-                img_data = requests.get(url_path).content
-                data_uri = self.convert_to_data_uri(img_data)
-                data_uris.append(data_uri)
-            return data_uris
+            if not paths:
+                return []
+            with ThreadPoolExecutor(max_workers=min(NOCODB_DOWNLOAD_CONCURRENCY, len(paths))) as download_pool, \
+                    ThreadPoolExecutor(max_workers=min(IMAGE_WORKERS, len(paths))) as transform_pool:
+                downloads = {download_pool.submit(self.download_image, path): index for index, path in enumerate(paths)}
+                transforms = {}
+                for future in as_completed(downloads):
+                    transforms[downloads[future]] = transform_pool.submit(self.convert_to_data_uri, future.result())
+                return [transforms[index].result() for index in range(len(paths))]
         except:
             raise
 
@@ -181,15 +274,7 @@ class Noco:
                 Exception: If there is an error converting the image data to a data URI
         """
         try:
-            with Image.open(BytesIO(image_data)) as img:
-                if img.mode == 'RGBA':
-                    img = img.convert('RGB')
-                width, height = img.size
-                new_size = (int(width * self.resolution_factor), int(height * self.resolution_factor))
-                resized_img = img.resize(new_size, Image.Resampling.LANCZOS)
-                buffer = BytesIO()
-                resized_img.save(buffer, format="JPEG")
-                resized_img_data = buffer.getvalue()
+            resized_img_data = utils.resize_to_jpeg(image_data, self.resolution_factor)
             base64_data = base64.b64encode(resized_img_data).decode('utf-8')
             return f"data:image/jpeg;base64,{base64_data}"
         except:
@@ -199,35 +284,173 @@ class Noco:
         """
             Get the artwork data from NocoDB with caching.
 
+            Cached data is returned right away and checked against the database in the background
+            at most every ARTWORK_REVALIDATE_SECONDS (stale while revalidate). Only the first load,
+            when nothing is cached yet, waits on the database.
+
+            Returns:
+                ArtObject: An object containing the artwork data
+
+            Raises:
+                Exception: If nothing is cached and there is an error loading the artwork data
+        """
+        artwork_data = self.previous_data.artwork
+        if artwork_data is None:
+            return self.flights.do("artwork", self.load_artwork_data, db, crud)
+        # No thread is started while a revalidation is running or the breaker would reject it
+        if self.get_artwork_staleness() >= ARTWORK_REVALIDATE_SECONDS and self.artwork_breaker.available():
+            self.flights.do_in_background("artwork", self.revalidate_artwork_data)
+        return artwork_data
+
+    def load_artwork_data(self, db: Session, crud: crud) -> ArtObject:
+        """
+            Load the artwork data from the database and cache it
+
             Returns:
                 ArtObject: An object containing the artwork data
 
             Raises:
-                Exception: If there is an error getting the artwork data with cache
+                RuntimeError: If refreshes are paused after repeated failures
+                Exception: If there is an error getting the artwork data
         """
+        if self.previous_data.artwork is not None:
+            return self.previous_data.artwork
+        if not self.artwork_breaker.allow():
+            raise RuntimeError(f"Artwork refresh paused after repeated failures, circuit {self.artwork_breaker.state}")
         try:
-            if self.compare_timestamps(db, crud):
-                self.clear_artwork_data_cache()
-                self.previous_data.artwork = self.get_artwork_data_no_cache(db, crud)
-            return self._get_artwork_data_cached()
+            artwork_data = self.get_artwork_data_no_cache(db, crud)
         except:
+            self.artwork_breaker.record_failure()
             raise
+        self.artwork_breaker.record_success()
+        self.set_artwork_data(artwork_data)
+        return artwork_data
+
+    def set_artwork_data(self, artwork_data: ArtObject) -> None:
+        self.previous_data.artwork = artwork_data
+        self.artwork_refreshed_at = time.time()
+        self.save_snapshot()
+
+    def revalidate_artwork_data(self) -> None:
+        """
+            Reload the artwork data if it changed in the database, failures keep the cached data.
+            Runs as the single background refresh for the artwork key. Only the worker holding the
+            refresher lock queries the database, the others follow the snapshot it writes.
+        """
+        if not snapshot.acquire_refresher_lock():
+            self.follow_snapshot()
+            return
+        if not self.artwork_breaker.allow():
+            return
+        db = SessionLocal()
+        try:
+            if self.compare_timestamps(db, crud):
+                self.set_artwork_data(self.get_artwork_data_no_cache(db, crud))
+            else:
+                self.artwork_refreshed_at = time.time()
+                # Followers take their staleness from the snapshot
+                snapshot.confirm_snapshot()
+            self.artwork_breaker.record_success()
+        except Exception as e:
+            self.artwork_breaker.record_failure()
+            logger.warning(
+                f"Artwork refresh failed, serving data {self.get_artwork_staleness():.0f}s stale, "
+                f"circuit {self.artwork_breaker.state}: {e}"
+            )
+        finally:
+            db.close()
 
-    @lru_cache(maxsize=1)
-    def _get_artwork_data_cached(self) -> ArtObject:
+    def get_catalog_version(self) -> str:
         """
-            Get the artwork data from NocoDB, this method is cached.
+            Identify the cached artwork and icon data, changes whenever either is reloaded with changes
+        """
+        artwork_data = self.previous_data.artwork
+        icon_data = self.previous_data.icon
+        return f"{artwork_data.version if artwork_data else '-'}.{icon_data.version if icon_data else '-'}"
+
+    def get_artwork_staleness(self) -> float:
+        """
+            Seconds since the artwork data was last confirmed against the database
+        """
+        if self.artwork_refreshed_at is None:
+            return 0.0
+        return time.time() - self.artwork_refreshed_at
+
+    def save_snapshot(self) -> None:
+        """
+            Persist the cached artwork and icon data so every worker can map it, start from it and
+            serve it during outages. Only the refresher writes, its own cache is then swapped for
+            the mapped copy so the data URIs are held once per machine.
+        """
+        if not snapshot.acquire_refresher_lock():
+            return
+        try:
+            snapshot.write_snapshot(self.previous_data.artwork, self.previous_data.icon)
+            self.use_snapshot(snapshot.read_snapshot())
+        except Exception as e:
+            logger.warning(f"Could not write catalog snapshot: {e}")
+
+    def use_snapshot(self, catalog: snapshot.CatalogSnapshot) -> None:
+        if catalog.artwork is not None:
+            self.previous_data.artwork = catalog.artwork
+        if catalog.icon is not None:
+            self.previous_data.icon = catalog.icon
+        self.snapshot_version = catalog.version
+
+    def load_snapshot(self) -> bool:
+        """
+            Load the cached artwork and icon data from the catalog snapshot
 
             Returns:
-                ArtObject: An object containing the artwork data
+                bool: True if a snapshot was loaded, False otherwise
+        """
+        try:
+            catalog = snapshot.read_snapshot()
+        except Exception as e:
+            logger.warning(f"Could not read catalog snapshot: {e}")
+            return False
+        if catalog is None:
+            return False
+        self.use_snapshot(catalog)
+        self.artwork_refreshed_at = catalog.written_at
+        logger.info(f"Loaded catalog snapshot written {catalog.age():.0f}s ago")
+        return True
+
+    def follow_snapshot(self) -> None:
+        """
+            Remap the catalog snapshot if the refresher replaced it since it was last loaded. The data
+            is as fresh as the refresher's last check, a stopped refresher shows up as growing staleness.
+        """
+        version = snapshot.snapshot_version()
+        if version is not None and version != self.snapshot_version:
+            self.load_snapshot()
+        confirmed_at = snapshot.confirmed_at()
+        if confirmed_at is not None:
+            self.artwork_refreshed_at = confirmed_at
+
+    def get_cached_artwork_value(self, title: str, field: str):
+        """
+            Get a field of an artwork from the cached artwork data, used when the database can't be reached
+
+            Arguments:
+                title (str): The title of the artwork
+                field (str): The ArtRecord field to read
+
+            Raises:
+                LookupError: If there is no cached artwork data or the title is not in it
         """
-        return self.previous_data.artwork
+        artwork_data = self.previous_data.artwork
+        record = artwork_data.get(title) if artwork_data is not None else None
+        if record is None:
+            raise LookupError(f"Artwork {title} is not cached")
+        logger.warning(f"Serving {field} for {title} from cache {self.get_artwork_staleness():.0f}s stale")
+        return getattr(record, field)
 
     def clear_artwork_data_cache(self):
         """
-            Clear the cache for artwork data.
+            Mark the artwork data as stale so the next request revalidates it.
         """
-        self._get_artwork_data_cached.cache_clear()
+        self.artwork_refreshed_at = 0.0
 
     def compare_timestamps(self, db : Session, crud : crud) -> bool:
         """
@@ -240,8 +463,8 @@ class Noco:
             if self.previous_data.artwork is None:
                 self.previous_data.artwork = self.get_artwork_data_no_cache(db, crud)
                 return False
-            old_data = self.previous_data.artwork.updated_ats
-            new_data = self.get_artwork_data_no_cache_no_datauri(db, crud).updated_ats
+            old_data = self.previous_data.artwork.timestamps()
+            new_data = dict(crud.get_artwork_timestamps(db, skip=0, limit=100))
             if new_data != old_data:
                 return True
             return False
@@ -264,12 +487,8 @@ class Noco:
             icon_paths = [ast.literal_eval(item.img)[0]['path'] for item in data]
             data_uris = self.convert_paths_to_data_uris(icon_paths)
             icon_data = IconObject(
-                icon_paths=icon_paths,
-                titles=[item.img_label for item in data],
-                data_uris=data_uris,
-                created_ats=[item.created_at for item in data],
-                updated_ats=[item.updated_at for item in data],
-                Ids=[item.id for item in data]
+                IconRecord(item.id, item.img_label, icon_path, data_uri, item.created_at, item.updated_at)
+                for item, icon_path, data_uri in zip(data, icon_paths, data_uris)
             )
             return icon_data
         
@@ -331,54 +550,11 @@ class Noco:
             Exception: If there is an error getting the artwork data without cache
         """
         try:
-            data = crud.get_artworks(db, skip=0, limit=100)
-            art_paths = [ast.literal_eval(item.img)[0]['path'] for item in data]
-            artwork_data = ArtObject(
-                titles=[item.img_label for item in data],
-                art_paths=art_paths,
-                sortorder=[item.sortorder for item in data],
-                prices=[item.price for item in data],
-                data_uris=[item.uri for item in data],
-                heights=[item.height for item in data],
-                widths=[item.width for item in data],
-                created_ats=[item.created_at for item in data],
-                updated_ats=[item.updated_at for item in data],
-                Ids=[item.id for item in data]
-            )
+            artwork_data = ArtObject.from_rows(crud.get_artworks(db, skip=0, limit=100))
             return artwork_data
         except:
             raise
 
-    def get_artwork_data_no_cache_no_datauri(self, db: Session, crud: crud) -> ArtObject:
-        """
-        Get the artwork data from NocoDB without caching and without data URIs.
-
-        Returns:
-            ArtObject: An object containing the artwork data without data URIs
-
-        Raises:
-            Exception: If there is an error getting the artwork data without cache and without data URIs
-        """
-        try:
-            data = crud.get_artworks(db, skip=0, limit=100)
-            art_paths = [ast.literal_eval(item.img)[0]['path'] for item in data]
-            artwork_data = ArtObject(
-                titles=[item.img_label for item in data],
-                art_paths=art_paths,
-                sortorder=[item.sortorder for item in data],
-                prices=[item.price for item in data],
-                heights=[item.height for item in data],
-                widths=[item.width for item in data],
-                data_uris=[item.uri for item in data],
-                created_ats=[item.created_at for item in data],
-                updated_ats=[item.updated_at for item in data],
-                Ids=[item.id for item in data]
-            )
-
-            return artwork_data
-        except:
-            raise
-    
     def pull_single_key_record(self, db: Session, crud: crud) -> dict:
         """
             Pull a single key record using the functions from the Noco class
@@ -404,7 +580,7 @@ class Noco:
         """
         try:
             artwork_data = self.previous_data.artwork
-            return artwork_data.updated_ats
+            return [record.updated_at for record in artwork_data]
         except:
             raise
 
@@ -440,12 +616,20 @@ class Noco:
             # Do a check to see if there is specific data in the IconObject that needs to be updated
             if self.previous_data.icon:
                 return self.previous_data.icon
-            else:
-                self.previous_data.icon = self.get_icon_data_no_cache(db, crud)
-                return self.previous_data.icon
+            return self.flights.do("icon", self.load_icon_data, db, crud)
         except:
             raise
 
+    def load_icon_data(self, db: Session, crud: crud) -> IconObject:
+        """
+            Load the icon data and cache it, runs once for all requests waiting on the icons
+        """
+        if self.previous_data.icon:
+            return self.previous_data.icon
+        self.previous_data.icon = self.get_icon_data_no_cache(db, crud)
+        self.save_snapshot()
+        return self.previous_data.icon
+
 
     def get_icon_uri_from_title(self, db: Session, crud: crud, title: str) -> str:
         """
@@ -461,9 +645,7 @@ class Noco:
                 ValueError: If the icon with the title is not found
         """
         try:
-            icon_data = self.get_icon_data(db, crud)
-            index = icon_data.titles.index(title)
-            return icon_data.data_uris[index]
+            return self.get_icon_data(db, crud).get(title).data_uri
         except:
             return ""
 
@@ -481,9 +663,7 @@ class Noco:
                 ValueError: If the artwork with the title is not found
         """
         try:
-            artwork_data = self.get_artwork_data_with_cache(db, crud)
-            index = artwork_data.titles.index(title)
-            return artwork_data.data_uris[index]
+            return self.get_artwork_data_with_cache(db, crud).get(title).data_uri
         except:
             return ""
 
@@ -502,8 +682,8 @@ class Noco:
         """
         try:
             return crud.get_artwork_by_label(db, title).price
-        except:
-            raise
+        except SQLAlchemyError:
+            return self.get_cached_artwork_value(title, "price")
 
     def get_art_price_from_title_and_quantity(self, db: Session, crud: crud, title: str, quantity: int) -> str:
         """
@@ -639,10 +819,6 @@ class Noco:
         except:
             return ""
 
-    @staticmethod
-    def get_version():
-        return str(int(time.time()))
-    
     def get_noco_cookie_data(self) -> CookieObject:
         """
             Get the cookie data from NocoDB
@@ -699,13 +875,19 @@ class Noco:
         """
         try:
             cookie_data = self.get_noco_cookie_data()
-            sessions = cookie_data.sessionids
             created_ats = cookie_data.created_ats
             current_time = datetime.now(timezone.utc)
-            for session_id, creation_time in zip(sessions, created_ats):
+            expired_ids = []
+            for record_id, creation_time in zip(cookie_data.Id, created_ats):
                 elapsed_time = (current_time - creation_time.replace(tzinfo=timezone.utc)).total_seconds()
                 if elapsed_time > self.cookie_session_time_limit:
-                    self.delete_noco_session_cookie(session_id)
+                    expired_ids.append(record_id)
+            if not expired_ids:
+                return
+            # The table is read once and the expired sessions deleted in batches, not one request each
+            result = self.delete_noco_table_data_bulk(NOCODB_TABLE_MAP.cookies_table, expired_ids)
+            for error in result.errors:
+                logger.error(f"Error deleting expired sessions: {error}")
         except:
             raise 
 
@@ -764,8 +946,8 @@ class Noco:
         """
         try:
             return crud.get_artwork_by_label(db, title).height
-        except:
-            raise
+        except SQLAlchemyError:
+            return self.get_cached_artwork_value(title, "height")
 
     def get_artwork_width_from_title(self, db: Session, crud: crud, title: str) -> str:
         """
@@ -782,5 +964,5 @@ class Noco:
         """
         try:
             return crud.get_artwork_by_label(db, title).width
-        except:
-            raise
+        except SQLAlchemyError:
+            return self.get_cached_artwork_value(title, "width")
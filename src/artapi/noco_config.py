@@ -1,13 +1,81 @@
 import os
+import json
+import time
+from typing import Union
 from src.artapi.noco import Noco
+from src.artapi.models import KeyObject
+from src.artapi.config import CACHE_DIR
 
-# Pull in the Noco object and postgreSQL connection
+# Last known copy of the key table, lets workers boot without waiting on NocoDB
+KEY_CACHE_PATH = os.path.join(CACHE_DIR, "key_table.json")
+# The key table this worker booted with, refreshes are compared against it
+loaded_key_data: Union[KeyObject, None] = None
 
-noco = Noco()
-key_data = noco.get_key_data_with_api()
+def read_key_cache() -> Union[KeyObject, None]:
+    """
+        Read the key table from the local cache file
 
-for i in range(len(key_data.envvars)):
-    os.environ[key_data.envvars[i]] = key_data.envvals[i]
+        Returns:
+            KeyObject: The cached key data, None if there is no usable cache
+    """
+    try:
+        with open(KEY_CACHE_PATH, "r") as f:
+            cached = json.load(f)
+        return KeyObject(envvars=cached["envvars"], envvals=cached["envvals"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+def write_key_cache(key_data: KeyObject) -> None:
+    """
+        Write the key table to the local cache file, readable by the owner only since it holds secrets
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{KEY_CACHE_PATH}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"envvars": key_data.envvars, "envvals": key_data.envvals}, f)
+    os.replace(tmp_path, KEY_CACHE_PATH)
+
+def apply_key_data(key_data: KeyObject) -> None:
+    for envvar, envval in zip(key_data.envvars, key_data.envvals):
+        os.environ[envvar] = envval
+
+def refresh_key_data() -> bool:
+    """
+        Fetch the key table from NocoDB, apply it to the environment and update the local cache.
+        Values already imported by other modules only pick up the change when the worker restarts.
+
+        Returns:
+            bool: True if the key table differs from the one this worker booted with
+    """
+    key_data = Noco().get_key_data_with_api()
+    apply_key_data(key_data)
+    if key_data != read_key_cache():
+        write_key_cache(key_data)
+    return key_data != loaded_key_data
+
+def load_key_data() -> str:
+    """
+        Load the key table from the local cache, whatever its age, and from NocoDB only when there
+        is no cache yet. The refresher checks the cache against NocoDB once the app is up.
+
+        Returns:
+            str: Where the key data was loaded from, cache or api
+    """
+    global loaded_key_data
+    key_data = read_key_cache()
+    source = "cache"
+    if key_data is None:
+        key_data = Noco().get_key_data_with_api()
+        write_key_cache(key_data)
+        source = "api"
+    apply_key_data(key_data)
+    loaded_key_data = key_data
+    return source
+
+_started = time.perf_counter()
+KEY_DATA_SOURCE = load_key_data()
+KEY_DATA_LOAD_SECONDS = time.perf_counter() - _started
 
 MIDDLEWARE_STRING = os.getenv("middleware_string")
 OPENAPI_URL = os.getenv("openapi_url")
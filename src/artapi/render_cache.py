@@ -0,0 +1,146 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Hashable, Tuple, Union
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from .compression import MINIMUM_SIZE, choose_encoding, compress, get_policy
+from .config import RENDER_CACHE_MAX_BYTES
+
+# Clients may store pages but have to revalidate them with the ETag before every use
+PAGE_CACHE_CONTROL = "no-cache"
+
+
+def make_etag(*parts) -> str:
+    """
+        Build a weak ETag from the values a response depends on, weak because the same page is sent in several encodings
+    """
+    digest = hashlib.sha1("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+        Check an If-None-Match header against an ETag, If-None-Match always uses the weak comparison
+    """
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(",") if tag.strip())
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": PAGE_CACHE_CONTROL, "Vary": "Accept-Encoding"})
+
+
+class CachedPage:
+    """
+    A rendered page stored raw, and compressed with an encoding the first time a client asks for it,
+    at the levels of the content type's compression policy
+    """
+    __slots__ = ("bodies", "media_type", "policy", "_owner")
+
+    def __init__(self, body: bytes, media_type: str = "text/html", owner: Union[tuple, None] = None):
+        self.bodies = {None: body}
+        self.media_type = media_type
+        self.policy = get_policy(media_type) if len(body) >= MINIMUM_SIZE else None
+        # The cache and key the page is stored under, told when a compressed body is added
+        self._owner = owner
+
+    @property
+    def body(self) -> bytes:
+        return self.bodies[None]
+
+    @property
+    def size(self) -> int:
+        return sum(len(body) for body in self.bodies.values())
+
+    def encoded(self, encoding: str) -> bytes:
+        body = self.bodies.get(encoding)
+        if body is None:
+            raw = self.bodies[None]
+            body = compress(raw, encoding, self.policy.level(encoding, len(raw)))
+            # Two requests may compress at once, the first body stored is kept and counted
+            if self.bodies.setdefault(encoding, body) is body and self._owner is not None:
+                cache, key = self._owner
+                cache.grow(key, self, len(body))
+            body = self.bodies[encoding]
+        return body
+
+    def response(self, request: Request, etag: Union[str, None] = None) -> Response:
+        """
+            Build the response for the request, a compressed body is sent as is when the client accepts its encoding
+        """
+        headers = {"Vary": "Accept-Encoding"}
+        if etag is not None:
+            headers["ETag"] = etag
+            headers["Cache-Control"] = PAGE_CACHE_CONTROL
+        encodings = self.policy.encodings if self.policy is not None else ()
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""), encodings)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+            return Response(content=self.encoded(encoding), media_type=self.media_type, headers=headers)
+        return Response(content=self.body, media_type=self.media_type, headers=headers)
+
+
+class RenderCache:
+    """
+    Rendered pages keyed by route and parameters for one catalog version.
+    Pages of an older catalog version are dropped as soon as a newer version is seen, and
+    the least recently used pages are evicted once max_bytes is exceeded.
+    """
+    def __init__(self, max_bytes: int = RENDER_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.version: Union[str, None] = None
+        # Each page with the bytes counted for it, compressed bodies are counted as they are added
+        self._pages: "OrderedDict[Hashable, Tuple[CachedPage, int]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, version: str) -> Union[CachedPage, None]:
+        with self._lock:
+            if version != self.version:
+                self._pages.clear()
+                self._size = 0
+                self.version = version
+            entry = self._pages.get(key)
+            if entry is None:
+                return None
+            self._pages.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, version: str, body: bytes, media_type: str = "text/html") -> CachedPage:
+        with self._lock:
+            # Rendered from a catalog that changed meanwhile, or too big to keep
+            if version != self.version or len(body) > self.max_bytes:
+                return CachedPage(body, media_type)
+            page = CachedPage(body, media_type, (self, key))
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._size -= old[1]
+            self._pages[key] = (page, len(body))
+            self._size += len(body)
+            self._evict()
+        return page
+
+    def grow(self, key: Hashable, page: CachedPage, added: int) -> None:
+        """
+            Count a compressed body added to a cached page, evicting pages when the budget is exceeded
+        """
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None or entry[0] is not page:
+                return
+            self._pages[key] = (page, entry[1] + added)
+            self._size += added
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes:
+            _, (_, counted) = self._pages.popitem(last=False)
+            self._size -= counted
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pages.clear()
+            self._size = 0
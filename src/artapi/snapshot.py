@@ -0,0 +1,204 @@
+import os
+import json
+import mmap
+import struct
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Union
+
+try:
+    import fcntl
+except ImportError:  # Windows, every worker refreshes on its own
+    fcntl = None
+
+from .config import CACHE_DIR
+from .models import ArtObject, IconObject
+
+# On disk layout: MAGIC | header length (uint64 little endian) | JSON header | data URI blob
+# Records are stored column by column in the header. Data URIs are stored as one ASCII blob
+# with (offset, length) spans in the header so the file can be memory mapped and sliced
+# instead of parsed. Every worker maps the same file, so the data URIs live once in the
+# shared page cache instead of once per worker heap.
+MAGIC = b"BRIGSNP2"
+PREFIX = struct.Struct("<8sQ")
+SNAPSHOT_PATH = os.path.join(CACHE_DIR, "catalog.snapshot")
+# Held by the one worker that refreshes the catalog and writes the snapshot
+REFRESHER_LOCK_PATH = os.path.join(CACHE_DIR, "catalog.lock")
+
+_refresher_lock_file = None
+
+DATETIME_FIELDS = {"created_at", "updated_at"}
+BLOB_FIELDS = {"data_uri"}
+
+class MappedString:
+    """
+    A string stored as a span of a memory mapped snapshot, decoded by str().
+    The mapping stays open as long as this object is referenced.
+    """
+    __slots__ = ("_view", "_offset", "_length")
+
+    def __init__(self, view: memoryview, offset: int, length: int):
+        self._view = view
+        self._offset = offset
+        self._length = length
+
+    def __str__(self) -> str:
+        return str(self._view[self._offset:self._offset + self._length], "ascii")
+
+@dataclass()
+class CatalogSnapshot:
+    written_at: float
+    artwork: Union[ArtObject, None] = None
+    icon: Union[IconObject, None] = None
+    # Identifies the file that was read, see snapshot_version
+    version: Union[tuple, None] = None
+
+    def age(self) -> float:
+        return time.time() - self.written_at
+
+def _encode_object(obj, blob: bytearray) -> Union[dict, None]:
+    if obj is None:
+        return None
+    encoded = {}
+    for name in obj.record_type.FIELDS:
+        column = [getattr(record, name) for record in obj]
+        if name in DATETIME_FIELDS:
+            column = [value.isoformat() if value else None for value in column]
+        elif name in BLOB_FIELDS:
+            spans = []
+            for value in column:
+                data = (value or "").encode("ascii")
+                spans.append([len(blob), len(data)])
+                blob.extend(data)
+            column = spans
+        encoded[name] = column
+    return encoded
+
+def _decode_object(cls, encoded: Union[dict, None], view: memoryview, blob_start: int):
+    if encoded is None:
+        return None
+    columns = []
+    for name in cls.record_type.FIELDS:
+        column = encoded[name]
+        if name in DATETIME_FIELDS:
+            column = [datetime.fromisoformat(value) if value else None for value in column]
+        elif name in BLOB_FIELDS:
+            column = [MappedString(view, blob_start + offset, length) for offset, length in column]
+        columns.append(column)
+    # One pass over the rows, records are built straight from the columns
+    return cls(cls.record_type(*values) for values in zip(*columns))
+
+def write_snapshot(artwork: Union[ArtObject, None], icon: Union[IconObject, None], path: str = SNAPSHOT_PATH) -> None:
+    """
+        Write the catalog to the snapshot file, the file is replaced atomically so readers never see a partial write
+
+        Arguments:
+            artwork (ArtObject): The artwork data to persist
+            icon (IconObject): The icon data to persist
+            path (str): The snapshot file path
+    """
+    blob = bytearray()
+    header = json.dumps({
+        "written_at": time.time(),
+        "artwork": _encode_object(artwork, blob),
+        "icon": _encode_object(icon, blob),
+    }).encode("utf-8")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(PREFIX.pack(MAGIC, len(header)))
+        f.write(header)
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+def read_snapshot(path: str = SNAPSHOT_PATH) -> Union[CatalogSnapshot, None]:
+    """
+        Map the snapshot file, data URIs are read from the mapping when accessed
+
+        Arguments:
+            path (str): The snapshot file path
+
+        Returns:
+            CatalogSnapshot: The persisted catalog, None if there is no snapshot
+
+        Raises:
+            ValueError: If the file is not a catalog snapshot
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        version = _version(os.fstat(f.fileno()))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, header_length = PREFIX.unpack_from(mapped, 0)
+    if magic != MAGIC:
+        mapped.close()
+        raise ValueError(f"{path} is not a catalog snapshot")
+    header_end = PREFIX.size + header_length
+    header = json.loads(mapped[PREFIX.size:header_end])
+    view = memoryview(mapped)
+    return CatalogSnapshot(
+        written_at=header["written_at"],
+        artwork=_decode_object(ArtObject, header["artwork"], view, header_end),
+        icon=_decode_object(IconObject, header["icon"], view, header_end),
+        version=version,
+    )
+
+def _version(stat: os.stat_result) -> tuple:
+    # Not the modification time, confirm_snapshot moves it without replacing the file
+    return (stat.st_ino, stat.st_size)
+
+def snapshot_version(path: str = SNAPSHOT_PATH) -> Union[tuple, None]:
+    """
+        Identify the current snapshot file, changes whenever the file is replaced
+
+        Returns:
+            tuple: The inode and size of the file, None if there is no snapshot
+    """
+    try:
+        return _version(os.stat(path))
+    except FileNotFoundError:
+        return None
+
+def confirm_snapshot(path: str = SNAPSHOT_PATH) -> None:
+    """
+        Record that the refresher checked the snapshot against the database and found it current
+    """
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+def confirmed_at(path: str = SNAPSHOT_PATH) -> Union[float, None]:
+    """
+        When the snapshot was last written or confirmed current by the refresher
+
+        Returns:
+            float: The modification time of the file, None if there is no snapshot
+    """
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+def acquire_refresher_lock(path: str = REFRESHER_LOCK_PATH) -> bool:
+    """
+        Try to become the worker that refreshes the catalog, the lock is held until the process exits
+
+        Returns:
+            bool: True if this process holds the lock
+    """
+    global _refresher_lock_file
+    if _refresher_lock_file is not None or fcntl is None:
+        return True
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _refresher_lock_file = lock_file
+    return True
@@ -0,0 +1,262 @@
+import os
+import re
+import hashlib
+import mimetypes
+from typing import Dict, List, Union
+
+from jinja2 import pass_context
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+from .compression import SUPPORTED_ENCODINGS, choose_encoding, compress
+from .render_cache import etag_matches
+
+# Versioned URLs never change content, so browsers and CDNs may keep them for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Unversioned URLs are revalidated with the ETag on every use
+REVALIDATE_CACHE_CONTROL = "no-cache"
+HASH_LENGTH = 12
+
+# Assets are compressed once at startup, so the slowest levels are used
+COMPRESSION_LEVELS = {"gzip": 9, "br": 11, "zstd": 19}
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "image/x-icon", "image/vnd.microsoft.icon")
+
+# Strings are matched first so comment markers inside them are kept
+_CSS_TOKENS = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*.*?\*/', re.S)
+
+
+def minify_css(text: str) -> str:
+    """
+        Strip comments, indentation and blank lines, line breaks are kept so no rule can change meaning
+    """
+    text = _CSS_TOKENS.sub(lambda m: "" if m.group(0).startswith("/*") else m.group(0), text)
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+def _js_literal_lines(text: str) -> Union[List[bool], None]:
+    """
+        Scan JavaScript for string and template literals, a backslash continued string or a template
+        literal can span lines
+
+        Returns:
+            list: For every line, whether it starts inside a literal. None if the literals don't balance,
+            e.g. around a regular expression the scan can't tell from a division
+    """
+    starts = [False]
+    state = None
+    # Brace depth of the code inside each open ${ of a template literal
+    templates = []
+    i, length = 0, len(text)
+    while i < length:
+        char = text[i]
+        if char == "\n":
+            if state in ("'", '"'):
+                return None
+            if state == "//":
+                state = None
+            starts.append(state == "`")
+        elif state is None:
+            if char in "'\"`":
+                state = char
+            elif text.startswith("//", i) or text.startswith("/*", i):
+                state = text[i:i + 2]
+                i += 1
+            elif templates and char == "{":
+                templates[-1] += 1
+            elif templates and char == "}":
+                if templates[-1]:
+                    templates[-1] -= 1
+                else:
+                    templates.pop()
+                    state = "`"
+        elif state == "/*":
+            if text.startswith("*/", i):
+                state = None
+                i += 1
+        elif state != "//":
+            if char == "\\":
+                if text.startswith("\n", i + 1):
+                    starts.append(True)
+                i += 1
+            elif char == state:
+                state = None
+            elif state == "`" and text.startswith("${", i):
+                templates.append(0)
+                state = None
+                i += 1
+        i += 1
+    if state not in (None, "//") or templates:
+        return None
+    return starts
+
+def minify_js(text: str) -> str:
+    """
+        Strip indentation and blank lines, line breaks are kept so automatic semicolon insertion is unchanged.
+        Whitespace inside string and template literals is kept, files the scan can't follow are left as they are.
+    """
+    text = text.replace("\r\n", "\n")
+    inside = _js_literal_lines(text)
+    if inside is None:
+        return text
+    # Whether each line ends inside a literal is whether the next one starts inside it
+    inside.append(False)
+    lines = []
+    for index, line in enumerate(text.split("\n")):
+        if not inside[index]:
+            line = line.lstrip()
+        if not inside[index + 1]:
+            line = line.rstrip()
+        if line or inside[index] or inside[index + 1]:
+            lines.append(line)
+    return "\n".join(lines)
+
+MINIFIERS = {".css": minify_css, ".js": minify_js}
+
+
+class StaticAsset:
+    """
+    A static file held in memory, minified, with a body for every content encoding that makes it smaller
+    """
+    __slots__ = ("version", "media_type", "bodies")
+
+    def __init__(self, version: str, media_type: str, bodies: Dict[Union[str, None], bytes]):
+        self.version = version
+        self.media_type = media_type
+        self.bodies = bodies
+
+    @classmethod
+    def build(cls, path: str, data: bytes, version: str) -> "StaticAsset":
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        minify = MINIFIERS.get(os.path.splitext(path)[1])
+        if minify is not None:
+            try:
+                data = minify(data.decode("utf-8")).encode("utf-8")
+            except UnicodeDecodeError:
+                pass
+        if media_type.startswith("text/") or media_type == "application/javascript":
+            media_type += "; charset=utf-8"
+        bodies = {None: data}
+        if media_type.startswith(COMPRESSIBLE_TYPES):
+            for encoding in SUPPORTED_ENCODINGS:
+                compressed = compress(data, encoding, COMPRESSION_LEVELS[encoding])
+                if len(compressed) < len(data):
+                    bodies[encoding] = compressed
+        return cls(version, media_type, bodies)
+
+    def etag(self, encoding: Union[str, None]) -> str:
+        return f'"{self.version}-{encoding}"' if encoding else f'"{self.version}"'
+
+
+def hash_files(directory: str) -> Dict[str, str]:
+    """
+        Hash the contents of every file under a directory
+
+        Returns:
+            dict: The short sha256 of every file, keyed by its path relative to the directory
+    """
+    hashes = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            full_path = os.path.join(root, name)
+            with open(full_path, "rb") as f:
+                hashes[os.path.relpath(full_path, directory).replace(os.sep, "/")] = hashlib.sha256(f.read()).hexdigest()[:HASH_LENGTH]
+    return hashes
+
+def combined_hash(hashes: Dict[str, str]) -> str:
+    """
+        Hash a set of file hashes into one version, it changes when any file is added, removed or changed
+    """
+    joined = "\n".join(f"{path}:{digest}" for path, digest in sorted(hashes.items()))
+    return hashlib.sha256(joined.encode("utf-8")).hexdigest()[:HASH_LENGTH]
+
+
+class StaticManifest:
+    """
+    Content hashes of the files in the static directory, keyed by their path relative to it,
+    with the prepared assets that are served from memory
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.hashes: Dict[str, str] = {}
+        self.assets: Dict[str, StaticAsset] = {}
+        self.build()
+
+    def build(self) -> None:
+        """
+            Hash, minify and compress every file under the static directory
+        """
+        hashes = hash_files(self.directory)
+        assets = {}
+        for path, digest in hashes.items():
+            with open(os.path.join(self.directory, path), "rb") as f:
+                assets[path] = StaticAsset.build(path, f.read(), digest)
+        self.hashes = hashes
+        self.assets = assets
+
+    @property
+    def version(self) -> str:
+        return combined_hash(self.hashes)
+
+    def get(self, path: str) -> Union[str, None]:
+        return self.hashes.get(path.lstrip("/"))
+
+
+def _cache_control(scope: Scope, version: Union[str, None]) -> str:
+    requested = QueryParams(scope.get("query_string", b"")).get("v")
+    if requested is not None and requested == version:
+        return IMMUTABLE_CACHE_CONTROL
+    return REVALIDATE_CACHE_CONTROL
+
+
+class VersionedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves the prepared assets of the manifest in the encoding the client accepts,
+    and lets clients cache a file forever when it is requested with its current content hash
+    """
+    def __init__(self, *args, manifest: StaticManifest, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manifest = manifest
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        asset = self.manifest.assets.get(path.replace(os.sep, "/"))
+        if asset is None or scope["method"] not in ("GET", "HEAD"):
+            # Files added after startup are served from disk
+            return await super().get_response(path, scope)
+
+        request_headers = Headers(scope=scope)
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""), tuple(e for e in asset.bodies if e))
+        headers = {
+            "ETag": asset.etag(encoding),
+            "Cache-Control": _cache_control(scope, asset.version),
+            "Vary": "Accept-Encoding",
+        }
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        if etag_matches(request_headers.get("if-none-match", ""), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        return Response(content=asset.bodies[encoding], media_type=asset.media_type, headers=headers)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        path = os.path.relpath(os.path.realpath(full_path), os.path.realpath(self.directory)).replace(os.sep, "/")
+        response.headers["Cache-Control"] = _cache_control(scope, self.manifest.get(path))
+        return response
+
+
+def static_url_global(manifest: StaticManifest):
+    """
+        Build the static_url template global, it renders url_for('static') with the content hash of the file
+
+        Arguments:
+            manifest (StaticManifest): The manifest of the static directory
+
+        Returns:
+            callable: The template global
+    """
+    @pass_context
+    def static_url(context, path: str) -> str:
+        url = str(context["request"].url_for("static", path=path))
+        version = manifest.get(path)
+        return f"{url}?v={version}" if version else url
+    return static_url
@@ -1,15 +1,108 @@
+import re
+import time
+import uuid
 import stripe
-import tempfile
 import requests
-import os
-from PIL import Image
+import json
+import hashlib
+import logging
+import threading
+from requests.adapters import HTTPAdapter
+from stripe._http_client import RequestsClient
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
-from .config import STRIPE_SECRET_KEY
+from sqlalchemy.orm import Session
+
+from . import crud, models, utils
+from .cache import SingleFlight, TTLCache
+from .config import (
+    NOCODB_PATH, STRIPE_SECRET_KEY, STRIPE_API_BASE, STRIPE_CONCURRENCY, PAYMENT_LINK_TTL_SECONDS, STRIPE_TIMEOUT_SECONDS, STRIPE_MAX_NETWORK_RETRIES
+)
+from .metrics import registry
+
+logger = logging.getLogger("brig_api")
+
+# Webhook events that change the local product and price mirror
+MIRROR_EVENTS = {
+    "product.created", "product.updated", "product.deleted",
+    "price.created", "price.updated", "price.deleted",
+}
+
+STRIPE_REQUEST_SECONDS = registry.histogram("stripe_request_seconds", "Latency of Stripe API calls by endpoint")
+# Object ids in Stripe paths, replaced so every product or price shares one endpoint label
+_STRIPE_ID = re.compile(r"/[a-z]+_(?=[A-Za-z0-9]*[A-Z0-9])[A-Za-z0-9]+")
+
+class MeteredRequestsClient(RequestsClient):
+    """
+    The Stripe SDK's requests client, recording the latency of every call per endpoint
+    """
+    def request(self, method, url, headers, post_data=None):
+        endpoint = _STRIPE_ID.sub("/{id}", url.split("?", 1)[0].split("://", 1)[-1].split("/", 1)[-1])
+        started = time.perf_counter()
+        status = "error"
+        try:
+            content, status, response_headers = super().request(method, url, headers, post_data)
+            return content, status, response_headers
+        finally:
+            STRIPE_REQUEST_SECONDS.observe(
+                time.perf_counter() - started, method=method.upper(), endpoint=f"/{endpoint}", status=str(status)
+            )
+
+def configure_stripe_client() -> None:
+    """
+        Route every Stripe call of this process through one keep-alive connection pool with
+        explicit timeouts and retries
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(STRIPE_CONCURRENCY, 10))
+    session.mount("https://", adapter)
+    stripe.api_key = STRIPE_SECRET_KEY
+    stripe.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+    stripe.default_http_client = MeteredRequestsClient(timeout=STRIPE_TIMEOUT_SECONDS, session=session)
+    if STRIPE_API_BASE:
+        stripe.api_base = STRIPE_API_BASE
+        stripe.upload_api_base = STRIPE_API_BASE
+
+def idempotency_key(*parts) -> str:
+    """
+        Build the idempotency key of a create call. Keys derived from the parameters let Stripe
+        answer a repeated create, from another worker or a retry, with the object it already
+        made. Without parts the key is random and only protects the SDK's own retries.
+    """
+    if not parts:
+        return str(uuid.uuid4())
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# Payment links by a hash of everything they were created with, shared by all requests of this worker
+payment_links = TTLCache(PAYMENT_LINK_TTL_SECONDS)
+payment_link_flights = SingleFlight()
+
+def _product_row(product) -> models.StripeProduct:
+    return models.StripeProduct(
+        product_id=product.id,
+        title=product.name,
+        default_price_id=product.get("default_price"),
+        image_path=(product.get("metadata") or {}).get("art_path"),
+        active=bool(product.get("active")) and not product.get("deleted", False),
+        created=product.get("created"),
+    )
+
+def _save_product(db: Session, product) -> None:
+    row = _product_row(product)
+    crud.upsert_stripe_product(db, row.product_id, row.title, row.default_price_id, row.active, row.created, row.image_path)
+
+def _price_row(price) -> models.StripePrice:
+    return models.StripePrice(
+        price_id=price.id,
+        product_id=price.product,
+        unit_amount=price.get("unit_amount"),
+        active=bool(price.get("active")) and not price.get("deleted", False),
+    )
 
 class StripeAPI:
     def __init__(self):
-        stripe.api_key = STRIPE_SECRET_KEY
+        configure_stripe_client()
         self.resolution_factor = 0.8
 
     def update_price(self, price_id: str, new_price: int) -> None:
@@ -23,7 +116,8 @@ class StripeAPI:
             price = stripe.Price.create(
                 product=product_id,
                 unit_amount=int(new_price) * 100,
-                currency='usd'
+                currency='usd',
+                idempotency_key=idempotency_key(),
             )
             return price
         except Exception as e:
@@ -59,29 +153,33 @@ class StripeAPI:
     def retrieve_product(self, product_id: str):
         return stripe.Product.retrieve(product_id)
 
-    def create_file(self, image_url: str) -> stripe.File:
+    def create_file(self, image_url: str, filename: str = "image.jpg") -> stripe.File:
         try:
             # Download the image from the URL
             response = requests.get(image_url)
             response.raise_for_status()
 
-            # Convert image bytes to processed image bytes
-            image_data = self.process_image(response.content)
-
-            # Create a temporary file
-            with tempfile.NamedTemporaryFile(delete=False, mode='wb') as temp_file:
-                temp_file.write(image_data)
-                temp_file_path = temp_file.name
-
-            # Open the temporary file and upload it to Stripe
-            with open(temp_file_path, "rb") as fp:
-                file = stripe.File.create(purpose='product_image', file=fp)
-
-
-            # Clean up the temporary file
-            os.remove(temp_file_path)
+            # Convert image bytes to processed image bytes and upload them straight from memory
+            return self.create_file_from_bytes(self.process_image(response.content), filename)
+        except Exception as e:
+            raise
 
-            return file
+    def create_file_from_bytes(self, image_data: bytes, filename: str = "image.jpg") -> stripe.File:
+        """
+        Upload an image to Stripe from memory
+        
+        Arguments:
+            image_data (bytes): The JPEG image data to upload
+            filename (str): The file name Stripe records for the upload
+        
+        Returns:
+            stripe.File: The uploaded file
+        """
+        try:
+            buffer = BytesIO(image_data)
+            # Stripe names the multipart upload after the file object's name
+            buffer.name = filename
+            return stripe.File.create(purpose='product_image', file=buffer, idempotency_key=idempotency_key())
         except Exception as e:
             raise
 
@@ -99,34 +197,63 @@ class StripeAPI:
             Exception: If there is an error processing the image data
         """
         try:
-            with Image.open(BytesIO(image_data)) as img:
-                if img.mode == 'RGBA':
-                    img = img.convert('RGB')
-                width, height = img.size
-                new_size = (int(width * self.resolution_factor), int(height * self.resolution_factor))
-                resized_img = img.resize(new_size, Image.Resampling.LANCZOS)
-                buffer = BytesIO()
-                resized_img.save(buffer, format="JPEG")
-                processed_img_data = buffer.getvalue()
-            return processed_img_data
+            return utils.resize_to_jpeg(image_data, self.resolution_factor)
         except Exception as e:
             raise
 
     def create_file_link(self, file_id: str) -> stripe.FileLink:
         try:
-            file_link = stripe.FileLink.create(file=file_id)
+            file_link = stripe.FileLink.create(file=file_id, idempotency_key=idempotency_key())
             return file_link
         except Exception as e:
             raise
 
-    def upload_image_to_stripe(self, file_url : str) -> stripe.FileLink:
+    def upload_image_to_stripe(self, data_uri: str, filename: str = "image.jpg") -> stripe.FileLink:
+        """
+        Upload a catalog image to Stripe and link it, the data URI already holds the resized
+        JPEG rendition so nothing is downloaded or resized again
+        
+        Arguments:
+            data_uri (str): The data URI of the artwork from the catalog
+            filename (str): The file name Stripe records for the upload
+        
+        Returns:
+            stripe.FileLink: The public link to the uploaded image
+
+        Raises:
+            ValueError: If the data URI is empty or malformed, before anything is uploaded
+        """
         try:
-            file = self.create_file(file_url)
+            file = self.create_file_from_bytes(utils.data_uri_to_bytes(data_uri), filename)
             file_link = self.create_file_link(file.id)
             return file_link
         except Exception as e:
             raise
 
+    def upload_artwork_image(self, record, filename: str = "image.jpg") -> stripe.FileLink:
+        """
+        Upload the image of an artwork to Stripe and link it, from its catalog data URI, or
+        downloaded from NocoDB when the data URI is missing or malformed
+
+        Arguments:
+            record (ArtRecord): The artwork
+            filename (str): The file name Stripe records for the upload
+
+        Returns:
+            stripe.FileLink: The public link to the uploaded image
+        """
+        try:
+            try:
+                return self.upload_image_to_stripe(record.data_uri, filename)
+            except ValueError:
+                if not record.art_path:
+                    raise
+                logger.warning(f"No usable data URI for {record.title}, uploading the image from NocoDB")
+            file = self.create_file(f"{NOCODB_PATH}/{record.art_path}", filename)
+            return self.create_file_link(file.id)
+        except Exception as e:
+            raise
+
     def update_product_image(self, product_id: str, image_url: str) -> None:
         try:
             existing_images = self.retrieve_product(product_id).images
@@ -135,71 +262,264 @@ class StripeAPI:
         except Exception as e:
             raise
 
-    def create_product(self, title: str, price: int, file_link: str) -> stripe.Product:
+    def create_product(self, title: str, price: int, file_link: str, metadata: dict = None) -> stripe.Product:
         try:
-            new_product = stripe.Product.create(
-                name=title,
-                tax_code="txcd_99999999",
-                default_price_data={
+            params = {
+                "name": title,
+                "metadata": metadata or {},
+                "tax_code": "txcd_99999999",
+                "default_price_data": {
                     'currency': 'usd',
                     'unit_amount': int(price) * 100,
                     'tax_behavior': 'exclusive'
                 },
-                images=[file_link],
-                shippable=True,
-            )
+                "images": [file_link],
+                "shippable": True,
+            }
+            # A retried create gets the product the first attempt made, Stripe rejects a key reused with other parameters
+            new_product = stripe.Product.create(**params, idempotency_key=idempotency_key("product", params))
             return new_product
         except Exception as e:
             raise
 
-    def sync_products(self, img_quant_list : list, path_list : list) -> list:
+    def reconcile_mirror(self, db: Session) -> None:
+        """
+            Replace the local product and price mirror with a full listing from Stripe
+
+            Arguments:
+                db (Session): The database session
+        """
+        try:
+            products = [_product_row(product) for product in stripe.Product.list(limit=100).auto_paging_iter()]
+            prices = [_price_row(price) for price in stripe.Price.list(limit=100).auto_paging_iter()]
+            crud.replace_stripe_mirror(db, products, prices)
+        except Exception as e:
+            raise
+
+    def ensure_mirror(self, db: Session) -> None:
+        # Before the first reconciliation an empty mirror would make every product look missing
+        if crud.count_stripe_products(db) == 0:
+            self.reconcile_mirror(db)
+
+    def apply_event(self, db: Session, event) -> bool:
+        """
+            Apply a Stripe webhook event to the local mirror
+
+            Arguments:
+                db (Session): The database session
+                event (stripe.Event): The verified webhook event
+
+            Returns:
+                bool: True if the event changed the mirror
+        """
+        try:
+            if event.type not in MIRROR_EVENTS:
+                return False
+            obj = event.data.object
+            if event.type.startswith("product."):
+                _save_product(db, obj)
+            else:
+                row = _price_row(obj)
+                crud.upsert_stripe_price(db, row.price_id, row.product_id, row.unit_amount, row.active)
+            return True
+        except Exception as e:
+            raise
+
+    def provision_catalog(self, db: Session, artwork_data) -> bool:
+        """
+            Create or update the Stripe product, image and price of every artwork ahead of checkout
+
+            Arguments:
+                db (Session): The database session
+                artwork_data (ArtObject): The artwork catalog
+
+            Returns:
+                bool: True if every artwork was provisioned, False if any failed and needs another pass
         """
-            Syncs the products in the stripe account with the products in the database
+        products = crud.get_active_stripe_products_by_title(db, [record.title for record in artwork_data])
+        prices = crud.get_active_stripe_prices(db, [product.product_id for product in products.values()])
+        provisioned = True
+        for record in artwork_data:
+            try:
+                self.provision_artwork(db, record, products.get(record.title), prices)
+            except Exception as e:
+                logger.error(f"Error provisioning Stripe product for {record.title}: {e}")
+                provisioned = False
+        return provisioned
+
+    def provision_artwork(self, db: Session, record, product: models.StripeProduct, prices: dict) -> None:
+        """
+            Bring the Stripe product of one artwork in line with the catalog
+
+            Arguments:
+                db (Session): The database session
+                record (ArtRecord): The artwork
+                product (StripeProduct): The mirrored product with the artwork title, None if there is none yet
+                prices (dict): The mirrored active prices keyed by product id and unit amount
+        """
+        try:
+            metadata = {"art_path": record.art_path}
+            if product is None:
+                file_link = self.upload_artwork_image(record, f"{record.Id}.jpg")
+                new_product = self.create_product(record.title, int(record.price), file_link.url, metadata=metadata)
+                _save_product(db, new_product)
+                crud.upsert_stripe_price(db, new_product.default_price, new_product.id, int(record.price) * 100, True)
+                return
+
+            product_id = product.product_id
+            default_price_id = product.default_price_id
+            if product.image_path is None:
+                # Made before image paths were recorded, adopt the current image instead of uploading it again
+                _save_product(db, stripe.Product.modify(product_id, metadata=metadata))
+            elif product.image_path != record.art_path:
+                file_link = self.upload_artwork_image(record, f"{record.Id}.jpg")
+                _save_product(db, stripe.Product.modify(product_id, images=[file_link.url], metadata=metadata))
+
+            price_id = prices.get((product_id, int(record.price) * 100))
+            if price_id is None:
+                price = self.create_price(product_id, int(record.price))
+                crud.upsert_stripe_price(db, price.id, product_id, price.unit_amount, True)
+                price_id = price.id
+            if default_price_id != price_id:
+                _save_product(db, stripe.Product.modify(product_id, default_price=price_id))
+        except Exception as e:
+            raise
+
+    def sync_products(self, img_quant_list : list, record_list : list, db: Session) -> list:
+        """
+            Resolves the cart lines to Stripe prices from the local mirror, Stripe is only called for
+            products and prices the mirror doesn't know yet
 
             Arguments:
                 img_quant_list (list): A list of dictionaries containing the product title, price and quantity
-                path_list (list): A list of image paths
+                record_list (list): The catalog record of each line's artwork
+                db (Session): The database session
 
             Returns:
                 list: A list of dictionaries containing the product price and quantity
         """
         try:
-            active_products = stripe.Product.list(active=True, limit=100).data
-            active_product_titles = [product.name for product in active_products]
-            active_product_ids = [product.id for product in active_products]
-            line_items = []
-            for each_product in img_quant_list:
+            self.ensure_mirror(db)
+            products = crud.get_active_stripe_products_by_title(db, [item['title'] for item in img_quant_list])
+            prices = crud.get_active_stripe_prices(db, [product.product_id for product in products.values()])
+            price_ids = []
+            # Lines the mirror can't resolve, keyed by title and unit amount so each is created once
+            missing = {}
+            for each_product, record in zip(img_quant_list, record_list):
                 title = each_product['title']
-                if title in active_product_titles:
-                    product_index = active_product_titles.index(title)
-                    product_id = active_product_ids[product_index]
-                    if self.price_match(product_id, each_product['price']):
-                        line_items.append({
-                            "price":self.retrieve_product(product_id).default_price,
-                            "quantity":each_product['quantity']}
-                            )
-                    else:
-                        default_price = self.check_price_existence(product_id, each_product['price'], each_product['quantity'])
-                        line_items.append({
-                            "price":default_price,
-                            "quantity":each_product['quantity']}
-                            )
-                else:
-                    title = each_product['title']
-                    price = each_product['price']
-                    quantity = each_product['quantity']
-                    image_url = path_list[img_quant_list.index(each_product)]
-                    file_link = self.upload_image_to_stripe(image_url)
-                    price_amount = (int(price) // int(quantity))
-                    new_product = self.create_product(title, price_amount, file_link.url)
-                    line_items.append({
-                        "price":new_product.default_price,
-                        "quantity":each_product['quantity']}
-                        )
-            return line_items
+                price_amount = (int(each_product['price']) // int(each_product['quantity']))
+                product = products.get(title)
+                price_id = prices.get((product.product_id, price_amount * 100)) if product is not None else None
+                if price_id is None:
+                    missing.setdefault((title, price_amount), (each_product, record, product))
+                price_ids.append(price_id)
+
+            if missing:
+                # Stripe calls for different lines don't depend on each other, run them side by side
+                with ThreadPoolExecutor(max_workers=min(STRIPE_CONCURRENCY, len(missing))) as pool:
+                    futures = {key: pool.submit(self.resolve_line, *line) for key, line in missing.items()}
+                # The session is not shared with the pool, the mirror is updated here once all calls are done.
+                # What the other lines created is recorded before a failed line's error is raised, so the
+                # next checkout doesn't create it again.
+                resolved = {}
+                error = None
+                for key, future in futures.items():
+                    try:
+                        price_id, new_product = future.result()
+                    except Exception as e:
+                        error = error or e
+                        continue
+                    if new_product is not None:
+                        _save_product(db, new_product)
+                    product_id = new_product.id if new_product is not None else missing[key][2].product_id
+                    crud.upsert_stripe_price(db, price_id, product_id, key[1] * 100, True)
+                    resolved[key] = price_id
+                if error is not None:
+                    raise error
+                for index, each_product in enumerate(img_quant_list):
+                    if price_ids[index] is None:
+                        key = (each_product['title'], int(each_product['price']) // int(each_product['quantity']))
+                        price_ids[index] = resolved[key]
+
+            return [
+                {"price": price_id, "quantity": each_product['quantity']}
+                for price_id, each_product in zip(price_ids, img_quant_list)
+            ]
+        except Exception as e:
+            raise
+
+    def resolve_line(self, each_product: dict, record, product: models.StripeProduct) -> tuple:
+        """
+            Create the Stripe product or price for a cart line the mirror doesn't know, safe to call from a worker thread
+
+            Arguments:
+                each_product (dict): The cart line with the product title, price and quantity
+                record (ArtRecord): The artwork
+                product (StripeProduct): The mirrored product with the title, None if there is none
+
+            Returns:
+                tuple: The price id for the line, and the new product if one was created
+        """
+        try:
+            price = each_product['price']
+            quantity = each_product['quantity']
+            if product is None:
+                file_link = self.upload_artwork_image(record)
+                new_product = self.create_product(each_product['title'], int(price) // int(quantity), file_link.url)
+                return new_product.default_price, new_product
+            return self.check_price_existence(product.product_id, price, quantity), None
         except Exception as e:
             raise
     
+    def create_payment_link(self, line_items: list, shipping_rate: str, redirect_url: str) -> str:
+        """
+            Get a payment link for the checkout, a link created for the same line items, shipping rate
+            and redirect URL within PAYMENT_LINK_TTL_SECONDS is reused instead of creating a new one
+
+            Arguments:
+                line_items (list): The resolved line items, price ids and quantities in cart order
+                shipping_rate (str): The Stripe shipping rate id
+                redirect_url (str): Where the customer goes after paying
+
+            Returns:
+                str: The payment link URL
+        """
+        try:
+            params = {
+                "line_items": line_items,
+                "automatic_tax": {
+                    "enabled": True,
+                    "liability": {
+                        "type": "self",
+                    }
+                },
+                "shipping_address_collection": {
+                    "allowed_countries": ["US"],
+                },
+                "shipping_options": [{
+                    "shipping_rate": shipping_rate,
+                }],
+                "after_completion": {
+                    "type": "redirect",
+                    "redirect": {
+                        "url": redirect_url,
+                    },
+                },
+            }
+            key = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+            url = payment_links.get(key)
+            if url is None:
+                # Once the cached link expires the next one is a new link, not the old one replayed by Stripe
+                window = int(time.time() // max(PAYMENT_LINK_TTL_SECONDS, 1))
+                # A double clicked checkout waits for the link the first click is creating
+                url = payment_link_flights.do(
+                    key, lambda: stripe.PaymentLink.create(**params, idempotency_key=idempotency_key("payment_link", key, window)).url
+                )
+                payment_links.put(key, url)
+            return url
+        except Exception as e:
+            raise
+
     def retrieve_price(self, price_id: str) -> stripe.Price:
         return stripe.Price.retrieve(price_id)
 
@@ -234,5 +554,16 @@ class StripeAPI:
         except Exception as e:
             raise
 
-def get_stripe_api():
-    return StripeAPI()
\ No newline at end of file
+_stripe_api = None
+_stripe_api_lock = threading.Lock()
+
+def get_stripe_api() -> StripeAPI:
+    """
+        The StripeAPI of this process, created on first use so the client is configured once
+    """
+    global _stripe_api
+    if _stripe_api is None:
+        with _stripe_api_lock:
+            if _stripe_api is None:
+                _stripe_api = StripeAPI()
+    return _stripe_api
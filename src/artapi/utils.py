@@ -1,4 +1,7 @@
+import base64
 from fractions import Fraction
+from io import BytesIO
+from PIL import Image
 
 def format_inches(value):
     # Convert the value to a fraction with denominator 4 (quarters)
@@ -19,4 +22,31 @@ def format_inches(value):
             f'<span class="fraction-bar"></span>'
             f'<span class="denominator">{fraction.denominator}</span>'
             f'</span><span class="inch-mark">"</span>'
-        )
\ No newline at end of file
+        )
+
+def resize_to_jpeg(image_data: bytes, resolution_factor: float) -> bytes:
+    """
+    Scale an image by resolution_factor and encode it as JPEG, the rendition used for the
+    catalog data URIs and the Stripe product images
+    """
+    with Image.open(BytesIO(image_data)) as img:
+        if img.mode == 'RGBA':
+            img = img.convert('RGB')
+        width, height = img.size
+        new_size = (int(width * resolution_factor), int(height * resolution_factor))
+        resized_img = img.resize(new_size, Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        resized_img.save(buffer, format="JPEG")
+        return buffer.getvalue()
+
+def data_uri_to_bytes(data_uri: str) -> bytes:
+    """
+    Decode a data:<media type>;base64,<data> URI
+
+    Raises:
+        ValueError: If the data URI is empty or malformed
+    """
+    header, separator, data = (data_uri or "").partition(",")
+    if not separator or not header.startswith("data:") or not data:
+        raise ValueError("Not a base64 data URI")
+    return base64.b64decode(data, validate=True)